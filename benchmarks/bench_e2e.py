@@ -0,0 +1,285 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+'''End-to-end benchmark'''
+# Builds a synthetic source tree of sparse movie, episode and .m4b files, points pyButler at the
+# stand-in TMDB server in tmdb_stub.py and times a full run:
+#   python -m benchmarks.bench_e2e --movies 2000 --episodes 2000 --books 200 --latency 20 -w 8
+# --entry main runs main() with --batch like a script would and reports how long each file took to
+# get its JSON line, from the start of the run. --entry process_file calls process_file() once per
+# file on a pool of workers and reports how long each call took. Every file has one place it should
+# end up, from the title it was named after; the run fails if any file is elsewhere or missing.
+
+WORDS = ("Silent", "Crimson", "River", "Empire", "Last", "Night", "Garden", "Iron", "Glass", "Winter",
+         "Signal", "Harbor", "Echo", "Paper", "Golden", "Shadow", "North", "Machine", "Lantern", "Storm")
+
+RELEASES = ("1080p.BluRay.x264-GRP", "2160p.WEB-DL.DDP5.1.HEVC-GRP", "720p.HDTV.x264-GRP", "WEBRip.x265-GRP")
+
+
+# "Crimson River Glass" style titles, unique per number
+def title(number):
+    words = []
+    while True:
+        number, index = divmod(number, len(WORDS))
+        words.append(WORDS[index])
+        if number == 0:
+            break
+        number -= 1
+    return " ".join(words + ["Story"] if len(words) < 2 else words)
+
+
+# Sparse, apart from the name at the start, so no two files are identical
+def sparse_file(file_path, size):
+    with open(file_path, "wb") as file:
+        file.write(os.path.basename(file_path).encode())
+        file.truncate(size)
+
+
+def atom(kind, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def text_atom(kind, value):
+    return atom(kind, atom(b"data", struct.pack(">II", 1, 0) + value.encode()))
+
+
+# Smallest .m4b mutagen will read and tag: ftyp, a sparse mdat, then moov with an mvhd and the
+# iTunes tags. moov goes last so saving new tags rewrites the end of the file, not all of it.
+def m4b_file(file_path, size, author, book_title):
+    matrix = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    mvhd = atom(b"mvhd", struct.pack(">IIIII", 0, 0, 0, 1000, 3600000) + b"\x00\x01\x00\x00\x01\x00" + b"\x00" * 10
+                + matrix + b"\x00" * 24 + struct.pack(">I", 2))
+    hdlr = atom(b"hdlr", b"\x00" * 8 + b"mdirappl" + b"\x00" * 9)
+    ilst = atom(b"ilst", text_atom(b"\xa9ART", author) + text_atom(b"\xa9nam", f"{book_title} (Unabridged)"))
+    moov = atom(b"moov", mvhd + atom(b"udta", atom(b"meta", b"\x00" * 4 + hdlr + ilst)))
+
+    with open(file_path, "wb") as file:
+        file.write(atom(b"ftyp", b"M4B \x00\x00\x02\x00isomM4B "))
+        file.write(struct.pack(">I4s", 8 + size, b"mdat"))
+        file.seek(size, os.SEEK_CUR)
+        file.write(moov)
+
+
+# Lay out the source tree, a few files per folder like a download directory. Returns (file_path,
+# destination) pairs, destination being where the file belongs relative to the benchmark's root:
+# named after the title it was generated from, with the years and episode names tmdb_stub.py gives.
+def build_tree(source, movies, episodes, books, shows, size):
+    files = []
+
+    for number in range(movies):
+        folder = os.path.join(source, "movies", f"{number // 50:03d}")
+        os.makedirs(folder, exist_ok=True)
+        movie_title, year = title(number), 1950 + number % 70
+        name = f"{movie_title.replace(' ', '.')}.{year}.{RELEASES[number % len(RELEASES)]}.mkv"
+        files.append((os.path.join(folder, name), os.path.join("movie", f"{movie_title} ({year}).mkv")))
+        sparse_file(files[-1][0], size)
+
+    for number in range(episodes):
+        show_number, episode = divmod(number, max(1, episodes // max(1, shows)))
+        season, episode = divmod(episode, 24)
+        show_title = title(show_number + 5000)
+        folder = os.path.join(source, "shows", show_title)
+        os.makedirs(folder, exist_ok=True)
+        code = f"S{season + 1:02d}E{episode + 1:02d}"
+        name = f"{show_title.replace(' ', '.')}.{code}.{RELEASES[number % len(RELEASES)]}.mp4"
+        destination = os.path.join("show", f"{show_title} (2010)", f"Season {season + 1:02d}",
+                                   f"{show_title} - {code} - Episode {episode + 1}.mp4")
+        files.append((os.path.join(folder, name), destination))
+        sparse_file(files[-1][0], size)
+
+    for number in range(books):
+        folder = os.path.join(source, "books")
+        os.makedirs(folder, exist_ok=True)
+        author, book_title = f"Author {number % 40}", title(number + 9000)
+        files.append((os.path.join(folder, f"book-{number:05d}.m4b"), os.path.join("audiobook", author, f"{book_title}.m4b")))
+        m4b_file(files[-1][0], size // 4, author, book_title)
+
+    return files
+
+
+# Run the stand-in server in its own process, so it doesn't share pyButler's GIL or memory
+def start_stub(args):
+    command = [sys.executable, "-m", "benchmarks.tmdb_stub", "--latency", str(args.latency), "--jitter", str(args.jitter),
+               "--rate-limit", str(args.rate_limit), "--throttle-every", str(args.throttle_every)]
+    stub = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    return stub, stub.stdout.readline().strip()
+
+
+def stub_stats(url):
+    with urllib.request.urlopen(url.rsplit("/", 1)[0] + "/_stats") as response:
+        return json.load(response)
+
+
+# pyButler's app directory lives under HOME, so the benchmark gets its own config, cache and state
+def setup_home(home, directories):
+    app_dir = os.path.join(home, ".config", "pyButler")
+    os.makedirs(app_dir, exist_ok=True)
+
+    with open(os.path.join(app_dir, "config.json"), "w") as file:
+        json.dump(directories, file, indent=2)
+    with open(os.path.join(app_dir, ".env"), "w") as file:
+        file.write("tmdb_api_key='benchmark'\n")
+
+
+# Seconds from the start of the run to each file's JSON line, skipped files aside. Files are all
+# there from the start, so this is how long each one waited for its lookup and transfer.
+def run_main(pybutler, args):
+    sys.argv = ["pybutler", "--batch", "--workers", str(args.workers), "--depth", "-1", "--transfer", args.transfer]
+    lines = io.StringIO()
+    start = time.time()
+    # With --batch only the JSON lines go to stdout, pyButler's other output goes to stderr
+    with contextlib.redirect_stdout(lines):
+        pybutler.main(pybutler.parse_args())
+
+    records = [json.loads(line) for line in lines.getvalue().splitlines()]
+    return [record["time"] - start for record in records if record["status"] != "skipped"]
+
+
+def run_process_file(pybutler, args, files, directories):
+    from core import cache, tmdb
+
+    client = tmdb.Client(api_key="benchmark", pool_size=max(10, args.workers))
+    client.cache = cache.MetadataCache()
+
+    def timed(file_path):
+        start = time.perf_counter()
+        pybutler.process_file(file_path, client, directories, pybutler.logger, mode=args.transfer)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        latencies = list(pool.map(timed, files))
+
+    client.cache.close()
+    return latencies
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+# Every file in the libraries, relative to root
+def organised_files(root, *directories):
+    return {os.path.relpath(os.path.join(folder, name), root)
+            for directory in directories for folder, _, names in os.walk(directory) for name in names}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Time a full pyButler run against a stand-in TMDB server.")
+    arg_parser.add_argument("--movies", type=int, default=1000, metavar="N")
+    arg_parser.add_argument("--episodes", type=int, default=1000, metavar="N")
+    arg_parser.add_argument("--books", type=int, default=100, metavar="N")
+    arg_parser.add_argument("--shows", type=int, default=40, metavar="N", help="shows the episodes are spread over")
+    arg_parser.add_argument("--size-mb", type=int, default=700, metavar="MB", help="apparent size of each file, they're sparse")
+    arg_parser.add_argument("-w", "--workers", type=int, default=8, metavar="N")
+    arg_parser.add_argument("--transfer", choices=("move", "hardlink", "reflink", "copy"), default="move")
+    arg_parser.add_argument("--entry", choices=("main", "process_file"), default="main")
+    arg_parser.add_argument("--latency", type=float, default=20.0, metavar="MS", help="server latency per request")
+    arg_parser.add_argument("--jitter", type=float, default=5.0, metavar="MS")
+    arg_parser.add_argument("--rate-limit", type=int, default=0, metavar="N", help="server replies 429 past N requests a second")
+    arg_parser.add_argument("--throttle-every", type=int, default=0, metavar="N", help="server replies 429 to every nth request")
+    arg_parser.add_argument("--dir", help="where to build the tree (default: a temporary directory, removed afterwards)")
+    arg_parser.add_argument("--verbose", action="store_true", help="show pyButler's own output")
+    args = arg_parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix="pybutler-bench-")
+    directories = {name: os.path.join(root, name) for name in ("source", "movie", "show", "audiobook")}
+    for directory in directories.values():
+        os.makedirs(directory, exist_ok=True)
+
+    stub, url = start_stub(args)
+
+    try:
+        # Both have to be set before pyButler is imported, its defaults are read at import time
+        os.environ["HOME"] = os.path.join(root, "home")
+        os.environ["PYBUTLER_TMDB_URL"] = url
+        setup_home(os.environ["HOME"], directories)
+
+        tree = build_tree(directories["source"], args.movies, args.episodes, args.books, args.shows, args.size_mb * 1024 * 1024)
+        files = [file_path for file_path, destination in tree]
+
+        import pybutler
+        from preferences import logging
+        pybutler.logger = logging.setup()
+
+        output = contextlib.ExitStack()
+        if not args.verbose:
+            output.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            output.enter_context(contextlib.redirect_stderr(io.StringIO()))
+        if not args.verbose:
+            pybutler.logger.setLevel("CRITICAL")
+
+        before = stub_stats(url)
+        start = time.perf_counter()
+        latencies = []
+        error = None
+        with output:
+            # A run that falls over still gets reported, up to where it got
+            try:
+                if args.entry == "main":
+                    latencies = run_main(pybutler, args)
+                else:
+                    latencies = run_process_file(pybutler, args, files, directories)
+            except (Exception, SystemExit) as e:
+                error = e
+            finally:
+                # pyButler's output is written by the logging thread, let it catch up while stdout is still redirected
+                logging.flush()
+        seconds = time.perf_counter() - start
+        after = stub_stats(url)
+
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    requests = after["requests"] - before["requests"]
+    throttled = after["throttled"] - before["throttled"]
+    expected = {destination for file_path, destination in tree}
+    organised = organised_files(root, directories["movie"], directories["show"], directories["audiobook"])
+    # Where no file should be, and where a file should be but isn't
+    misplaced = sorted(organised - expected)
+    missing = sorted(expected - organised)
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+    print(f"Files      → {len(files)} ({len(organised & expected)} organised, {len(missing)} left behind, {len(misplaced)} misplaced)")
+    print(f"Time       → {seconds:.2f}s | {len(files) / seconds:,.1f} files/sec")
+    print(f"Requests   → {requests} ({requests / len(files):.2f} per file, {throttled} throttled)")
+    if latencies:
+        measured = "from the start of the run" if args.entry == "main" else "per call"
+        print(f"Latency    → p50 {percentile(latencies, 50) * 1000:.1f} ms | p99 {percentile(latencies, 99) * 1000:.1f} ms ({measured})")
+    print(f"Peak RSS   → {peak_rss:.1f} MB")
+    if error is not None:
+        print(f"Run failed → {type(error).__name__}: {error}")
+    for label, paths in (("Misplaced", misplaced), ("Missing", missing)):
+        for path in paths[:10]:
+            print(f"{label:<10} → {path}")
+        if len(paths) > 10:
+            print(f"{'':<10}   ...and {len(paths) - 10} more")
+
+    if not args.dir:
+        shutil.rmtree(root, ignore_errors=True)
+
+    # So a regression fails whatever runs the benchmark
+    if misplaced or missing or error is not None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
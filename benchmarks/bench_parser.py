@@ -0,0 +1,182 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import parser
+
+
+P = parser.ParsedName
+
+# Release names in the shapes seen in the wild: scene, P2P, hand-renamed and already organised files,
+# each with what it must parse to: kind, title, year, season, episodes, resolution, tags, extension
+EXPECTED = (
+    ('Show.Name.S01E01.720p.HDTV.x264-GRP.mkv',
+     P('episode', 'Show Name', None, 1, [1], '720p', ['hdtv', 'x264'], '.mkv')),
+    ('Show.Name.2019.S01E02E03.1080p.WEB-DL.x264-GRP.mkv',
+     P('episode', 'Show Name', 2019, 1, [2, 3], '1080p', ['web-dl', 'x264'], '.mkv')),
+    ('Show Name (2019) - S02E10 - Episode Title.mkv',
+     P('episode', 'Show Name', 2019, 2, [10], None, [], '.mkv')),
+    ('show_name_s03e04_hdtv.mp4',
+     P('episode', 'show name', None, 3, [4], None, ['hdtv'], '.mp4')),
+    ('Doctor.Who.2005.S10E01.The.Pilot.1080p.AMZN.WEB-DL.DDP5.1.H.264-NTb.mkv',
+     P('episode', 'Doctor Who', 2005, 10, [1], '1080p', ['web-dl', 'ddp5.1', 'h.264'], '.mkv')),
+    ('The.Office.US.S05E14-E15.Stress.Relief.720p.WEB-DL.mkv',
+     P('episode', 'The Office US', None, 5, [14, 15], '720p', ['web-dl'], '.mkv')),
+    ('Cool.Show.-.S1E5.-.Title.mp4',
+     P('episode', 'Cool Show', None, 1, [5], None, [], '.mp4')),
+    ('Movie.Name.2001.1080p.BluRay.x264-GRP.mkv',
+     P('movie', 'Movie Name', 2001, None, [], '1080p', ['bluray', 'x264'], '.mkv')),
+    ('Movie Name (2001).mkv',
+     P('movie', 'Movie Name', 2001, None, [], None, [], '.mkv')),
+    ('Blade.Runner.2049.2017.2160p.UHD.BluRay.REMUX.HDR.HEVC.Atmos-EPSiLON.mkv',
+     P('movie', 'Blade Runner 2049', 2017, None, [], '2160p', ['bluray', 'remux', 'hdr', 'hevc', 'atmos'], '.mkv')),
+    ('2001.A.Space.Odyssey.1968.REMASTERED.1080p.BluRay.x265.10bit.AAC5.1.mkv',
+     P('movie', '2001 A Space Odyssey', 1968, None, [], '1080p', ['remastered', 'bluray', 'x265', '10bit'], '.mkv')),
+    ('Spider-Man.No.Way.Home.2021.2160p.WEB-DL.DDP5.1.Atmos.DV.HEVC-CMRG.mkv',
+     P('movie', 'Spider-Man No Way Home', 2021, None, [], '2160p', ['web-dl', 'ddp5.1', 'atmos', 'dv', 'hevc'], '.mkv')),
+    ('[Group] Movie Name [1999] [1080p].mp4',
+     P('movie', 'Movie Name', 1999, None, [], '1080p', [], '.mp4')),
+    ('movie.name.1995.dvdrip.xvid.mp4',
+     P('movie', 'movie name', 1995, None, [], None, ['dvdrip', 'xvid'], '.mp4')),
+    ('Home.Video.mkv',
+     P('unknown', 'Home Video', None, None, [], None, [], '.mkv')),
+)
+
+NAMES = tuple(name for name, expected in EXPECTED)
+
+
+# Names that don't parse as expected, as (name, expected, got). Timing a parser that's wrong is no use.
+def check():
+    return [(name, expected, parser.parse(name)) for name, expected in EXPECTED if parser.parse(name) != expected]
+
+
+# Pieces the timing corpus is put together from. Titles with numbers, years, hyphens and articles in
+# them, the way real ones have.
+MOVIES = (
+    ("The Matrix", 1999), ("Blade Runner 2049", 2017), ("2001 A Space Odyssey", 1968), ("Spider-Man No Way Home", 2021),
+    ("Ocean's Eleven", 2001), ("Mad Max Fury Road", 2015), ("The Lord of the Rings The Two Towers", 2002),
+    ("Se7en", 1995), ("1917", 2019), ("Die Hard", 1988), ("Alien", 1979), ("Amelie", 2001), ("Parasite", 2019),
+    ("No Country for Old Men", 2007), ("The Good the Bad and the Ugly", 1966), ("Everything Everywhere All at Once", 2022),
+    ("Back to the Future Part II", 1989), ("Star Wars Episode IV A New Hope", 1977), ("Dune Part Two", 2024),
+    ("Mission Impossible Dead Reckoning Part One", 2023), ("The Thing", 1982), ("Heat", 1995), ("Oppenheimer", 2023),
+    ("Crouching Tiger Hidden Dragon", 2000), ("Pan's Labyrinth", 2006), ("Rocky III", 1982), ("Saw II", 2005),
+    ("Fast X", 2023), ("Toy Story 3", 2010), ("WALL-E", 2008), ("X-Men Days of Future Past", 2014),
+)
+SHOWS = (
+    ("Doctor Who", 2005), ("The Office US", None), ("Breaking Bad", None), ("Game of Thrones", None),
+    ("The Last of Us", 2023), ("Stranger Things", None), ("Better Call Saul", None), ("Battlestar Galactica", 2004),
+    ("The Expanse", None), ("Chernobyl", None), ("House of the Dragon", None), ("Shogun", 2024), ("Dark", None),
+    ("Star Trek The Next Generation", None), ("Mr Robot", None), ("Twin Peaks", 1990), ("The Wire", None),
+    ("Only Murders in the Building", None), ("S.W.A.T.", 2017), ("9-1-1", None), ("Money Heist", None),
+)
+RESOLUTIONS = ("480p", "576p", "720p", "1080p", "1080i", "2160p", "4K", "UHD")
+SOURCES = ("BluRay", "Blu-Ray", "BDRip", "BRRip", "REMUX", "WEB-DL", "WEBRip", "WEB", "HDTV", "HDRip", "DVDRip")
+CODECS = ("x264", "x265", "H.264", "H264", "HEVC", "AVC", "XviD", "10bit")
+AUDIO = ("AAC", "AAC2.0", "AC3", "EAC3", "DTS", "DTS-HD", "TrueHD", "Atmos", "DDP5.1", "DD5.1")
+EXTRAS = ("PROPER", "REPACK", "EXTENDED", "UNRATED", "REMASTERED", "IMAX", "INTERNAL", "LIMITED", "HDR", "HDR10", "DV")
+GROUPS = ("GRP", "NTb", "EPSiLON", "CMRG", "FLUX", "SPARKS", "RARBG", "YTS", "TGx", "playWEB")
+EPISODE_TITLES = ("Pilot", "The One Where It Ends", "Part 2", "Ozymandias", "Winter Is Coming", "Rose", "Stress Relief")
+EXTENSIONS = (".mkv", ".mkv", ".mp4", ".avi")
+
+
+def release(rng):
+    parts = [rng.choice(RESOLUTIONS)] if rng.random() < 0.85 else []
+    parts += rng.sample(EXTRAS, rng.choice((0, 0, 1, 2)))
+    parts += [rng.choice(SOURCES), rng.choice(CODECS)]
+    parts += [rng.choice(AUDIO)] if rng.random() < 0.5 else []
+    return parts
+
+
+def episode_code(rng):
+    season, episode = rng.randint(1, 15), rng.randint(1, 24)
+    code = rng.choice(("S{:02d}E{:02d}", "S{}E{}", "s{:02d}e{:02d}"))
+    code = code.format(season, episode)
+    if rng.random() < 0.1:
+        code += rng.choice(("E{:02d}", "-E{:02d}")).format(episode + 1)
+    return code
+
+
+# One name in one of the shapes files turn up in
+def release_name(rng):
+    shape = rng.random()
+    extension = rng.choice(EXTENSIONS)
+
+    if shape < 0.45:
+        title, year = rng.choice(MOVIES)
+        release_parts = release(rng)
+        if shape < 0.25:
+            # Scene: Title.Year.1080p.BluRay.x264-GRP
+            name = ".".join([*title.split(), str(year), *release_parts]) + f"-{rng.choice(GROUPS)}"
+        elif shape < 0.32:
+            # P2P: [Group] Title [Year] [1080p]
+            name = f"[{rng.choice(GROUPS)}] {title} [{year}] [{release_parts[0]}]"
+        elif shape < 0.40:
+            # Renamed by hand, or by pyButler itself
+            name = f"{title} ({year})" + (f" - {release_parts[0]}" if rng.random() < 0.3 else "")
+        else:
+            name = "_".join([*title.lower().split(), str(year), *release_parts[:2]])
+        return name + extension
+
+    if shape < 0.95:
+        title, year = rng.choice(SHOWS)
+        year = year if year and rng.random() < 0.5 else None
+        code = episode_code(rng)
+        if shape < 0.75:
+            # Scene: Show.2005.S01E01.Title.720p.HDTV.x264-GRP
+            words = [*title.split(), *([str(year)] if year else []), code]
+            words += rng.choice(EPISODE_TITLES).split() if rng.random() < 0.4 else []
+            name = ".".join(words + release(rng)) + f"-{rng.choice(GROUPS)}"
+        elif shape < 0.87:
+            # Renamed: Show (2005) - S01E01 - Title
+            name = f"{title}{f' ({year})' if year else ''} - {code} - {rng.choice(EPISODE_TITLES)}"
+        else:
+            name = "_".join([*title.lower().split(), code.lower(), rng.choice(SOURCES).lower()])
+        return name + extension
+
+    # No year or episode: home videos, camera files, samples
+    return rng.choice(("Home.Video", "IMG_{:04d}", "Birthday Party {}", "sample-{}", "VTS_01_{}")).format(rng.randint(1, 9999)) + extension
+
+
+# `count` names for timing. Generated from a fixed seed, so every run times the same corpus.
+def corpus(count, seed=0):
+    rng = random.Random(seed)
+    return [release_name(rng) for _ in range(count)]
+
+
+def run(names, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for name in names:
+            parser.parse(name)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure filename parses per second.")
+    arg_parser.add_argument("--count", type=int, default=100000, help="names to parse per round (default: 100000)")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="rounds to run, the best is reported (default: 5)")
+    args = arg_parser.parse_args()
+
+    failures = check()
+    for name, expected, got in failures:
+        print(f"{name}\n  expected {expected}\n  got      {got}")
+    if failures:
+        sys.exit(f"{len(failures)} of {len(EXPECTED)} names parsed wrongly")
+
+    names = corpus(args.count)
+    seconds = run(names, args.repeat)
+
+    print(f"{len(names)} names in {seconds:.3f}s | {len(names) / seconds:,.0f} parses/sec")
+
+
+if __name__ == '__main__':
+    main()
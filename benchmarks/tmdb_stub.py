@@ -0,0 +1,167 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Routes of the TMDB API pyButler uses. Every query gets an answer, built from the query itself.
+SEASON = re.compile(r"^/3/tv/(\d+)/season/(\d+)$")
+TV = re.compile(r"^/3/tv/(\d+)$")
+MOVIE = re.compile(r"^/3/movie/(\d+)$")
+
+'''Stand-in for the TMDB API'''
+# Answers searches with the title that was asked for (plus a less popular decoy), seasons with
+# `episodes` numbered episodes, and details for any id. Adds `latency` seconds to every request
+# and, like TMDB, replies 429 with a Retry-After header once `rate_limit` requests a second are
+# exceeded. `throttle_every` > 0 also throttles every nth request, whatever the rate.
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, rate_limit=0, throttle_every=0, episodes=30):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.throttle_every = throttle_every
+        self.episodes = episodes
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.window = (0, 0)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/3"
+
+    # Count the request, and decide whether it's over the limit
+    def admit(self):
+        with self.lock:
+            self.requests += 1
+            second, count = self.window
+            now = int(time.monotonic())
+            self.window = (now, count + 1) if now == second else (now, 1)
+
+            over_limit = self.rate_limit and self.window[1] > self.rate_limit
+            nth = self.throttle_every and self.requests % self.throttle_every == 0
+            if over_limit or nth:
+                self.throttled += 1
+                return False
+
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "throttled": self.throttled}
+
+
+# Connections are kept alive, like TMDB's. Replies are buffered and sent in one write once the body
+# is in (the server flushes after each request), so Nagle's algorithm and delayed ACKs don't hold
+# up every request on a reused connection.
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        # Bookkeeping for the benchmark, not part of TMDB
+        if url.path == "/_stats":
+            return self.reply(200, self.server.stats())
+
+        if not self.server.admit():
+            body = {"status_code": 25, "status_message": "Your request count is over the allowed limit."}
+            return self.reply(429, body, {"Retry-After": "1"})
+
+        time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        status, body = self.route(url.path, query)
+        self.reply(status, body)
+
+    def route(self, path, query):
+        if path == "/3/search/movie":
+            return 200, {"results": search_movie(query.get("query", ""), query.get("year"))}
+        if path == "/3/search/tv":
+            return 200, {"results": search_tv(query.get("query", ""), query.get("first_air_date_year"))}
+
+        season = SEASON.match(path)
+        if season:
+            episodes = [{"episode_number": number, "name": f"Episode {number}"} for number in range(1, self.server.episodes + 1)]
+            return 200, {"season_number": int(season.group(2)), "episodes": episodes}
+
+        tv = TV.match(path)
+        if tv:
+            return 200, {"id": int(tv.group(1)), "name": f"Show {tv.group(1)}", "first_air_date": "2010-01-01"}
+
+        movie = MOVIE.match(path)
+        if movie:
+            return 200, {"id": int(movie.group(1)), "title": f"Movie {movie.group(1)}", "release_date": "2000-01-01"}
+
+        return 404, {"status_code": 34, "status_message": "The resource you requested could not be found."}
+
+    def reply(self, status, body, headers={}):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Stable ids, so the same title always gets the same id
+def title_id(title):
+    return zlib.crc32(title.lower().encode()) % 10_000_000
+
+
+def search_movie(title, year):
+    year = year or "2000"
+    return [
+        {"id": title_id(title), "title": title, "release_date": f"{year}-06-01", "popularity": 40.0},
+        {"id": title_id(title + " decoy"), "title": f"{title} Returns", "release_date": f"{int(year) + 3}-06-01", "popularity": 5.0},
+    ]
+
+
+def search_tv(title, year):
+    year = year or "2010"
+    return [
+        {"id": title_id(title), "name": title, "first_air_date": f"{year}-01-01", "popularity": 40.0},
+        {"id": title_id(title + " decoy"), "name": f"{title} Revisited", "first_air_date": f"{int(year) + 8}-01-01", "popularity": 5.0},
+    ]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Serve a stand-in for the TMDB API.")
+    arg_parser.add_argument("--port", type=int, default=0, help="port to listen on (default: any free port)")
+    arg_parser.add_argument("--latency", type=float, default=0.0, metavar="MS", help="added to every request")
+    arg_parser.add_argument("--jitter", type=float, default=0.0, metavar="MS", help="random extra latency, up to MS")
+    arg_parser.add_argument("--rate-limit", type=int, default=0, metavar="N", help="reply 429 past N requests a second")
+    arg_parser.add_argument("--throttle-every", type=int, default=0, metavar="N", help="reply 429 to every nth request")
+    arg_parser.add_argument("--episodes", type=int, default=30, metavar="N", help="episodes in every season (default: 30)")
+    args = arg_parser.parse_args()
+
+    server = Server(("127.0.0.1", args.port), latency=args.latency / 1000, jitter=args.jitter / 1000,
+                    rate_limit=args.rate_limit, throttle_every=args.throttle_every, episodes=args.episodes)
+
+    # The benchmark reads the address from this line
+    print(server.url, flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from preferences import paths
+
+
+# How long to keep each kind of TMDB response, matched against the endpoint path
+TTLS = (
+    (re.compile(r"^/search/"), timedelta(days=30)),
+    (re.compile(r"^/tv/\d+/season/"), timedelta(days=7)), # new episodes get added to running seasons
+    (re.compile(r"^/(movie|tv)/\d+$"), timedelta(days=90)),
+)
+DEFAULT_TTL = timedelta(days=30)
+# "No results" answers are kept for a shorter time, TMDB may simply not have the title yet
+NEGATIVE_TTL = timedelta(days=1)
+DEFAULT_SIZE_MB = 64
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    endpoint TEXT NOT NULL,
+    body TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    negative INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+'''
+
+
+def cache_file():
+    return paths.app() / 'cache.sqlite'
+
+# Cache key for a request: the path plus its sorted parameters (never the api key)
+def make_key(path, params):
+    params = sorted((name, str(value)) for name, value in params.items() if name != 'api_key')
+    return f"{path}?{urlencode(params)}"
+
+# Collapse ids in a path, so stats group by endpoint: /tv/1399/season/1 -> /tv/{id}/season/{id}
+def endpoint_of(path):
+    return re.sub(r"/\d+", "/{id}", path)
+
+
+def ttl_for(path, negative):
+    if negative:
+        return NEGATIVE_TTL
+
+    for pattern, ttl in TTLS:
+        if pattern.search(path):
+            return ttl
+
+    return DEFAULT_TTL
+
+
+'''Persistent TMDB metadata cache'''
+# One SQLite file in the app directory, shared by every endpoint and kept between runs.
+# Least recently used entries are evicted once the total size goes over max_size_mb.
+# Each host keeps its own: SQLite's locking can't be relied on over a network filesystem.
+class MetadataCache:
+    def __init__(self, path=None, max_size_mb=DEFAULT_SIZE_MB):
+        self.path = path or cache_file()
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    # Returns the cached body, or None if missing or expired
+    def get(self, key):
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute("SELECT body, expires FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+
+            self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, path, key, body, negative=False):
+        now = time.time()
+        text = json.dumps(body, separators=(',', ':'))
+        expires = now + ttl_for(path, negative).total_seconds()
+
+        with self.lock:
+            old = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, endpoint_of(path), text, len(text), int(negative), expires, now),
+            )
+            self.size += len(text) - (old[0] if old else 0)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    # (key, body) of every live, non-negative entry for an endpoint, e.g. "/search/movie"
+    def entries(self, endpoint):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, body FROM entries WHERE endpoint = ? AND negative = 0 AND expires >= ?", (endpoint, time.time())
+            ).fetchall()
+
+        for key, body in rows:
+            yield key, json.loads(body)
+
+    # Drop least recently used entries until the cache is back under 90% of its cap.
+    # Callers hold self.lock.
+    def evict(self):
+        target = self.max_size * 0.9
+        rows = self.db.execute("SELECT key, size FROM entries ORDER BY accessed")
+
+        doomed = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            doomed.append((key,))
+            self.size -= size
+
+        self.db.executemany("DELETE FROM entries WHERE key = ?", doomed)
+        return len(doomed)
+
+    # Remove expired entries, then evict down to the size cap. Returns the number of entries removed.
+    def prune(self):
+        with self.lock:
+            expired = self.db.execute("DELETE FROM entries WHERE expires < ?", (time.time(),)).rowcount
+            self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            evicted = self.evict() if self.size > self.max_size else 0
+            self.db.execute("VACUUM")
+
+        return expired + evicted
+
+    def stats(self):
+        now = time.time()
+
+        with self.lock:
+            entries, negative, expired = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(negative), 0), COALESCE(SUM(expires < ?), 0) FROM entries", (now,)
+            ).fetchone()
+            endpoints = self.db.execute(
+                "SELECT endpoint, COUNT(*), SUM(size) FROM entries GROUP BY endpoint ORDER BY endpoint"
+            ).fetchall()
+
+        return {
+            'path': str(self.path),
+            'entries': entries,
+            'negative': negative,
+            'expired': expired,
+            'size': self.size,
+            'max_size': self.max_size,
+            'endpoints': {endpoint: {'entries': count, 'size': size} for endpoint, count, size in endpoints},
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def close(self):
+        self.db.close()
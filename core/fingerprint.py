@@ -0,0 +1,288 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+
+from core import metrics, scanner, transfer
+from preferences import paths
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    fingerprint TEXT,
+    updated REAL NOT NULL
+);
+'''
+
+# Bytes hashed from each of the start, middle and end of a file
+SAMPLE_SIZE = 256 * 1024
+
+
+def fingerprint_file():
+    return paths.app() / 'fingerprints.sqlite'
+
+
+# The size and a hash of three samples of the file, so the cost is the same for a 1 MB book as for
+# a 50 GB remux. Files smaller than the three samples together are hashed whole.
+def fingerprint(file_path):
+    with metrics.timer("fingerprint"), open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        digest = hashlib.blake2b(digest_size=16)
+
+        # Empty files can't be mapped
+        if size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if size <= 3 * SAMPLE_SIZE:
+                    digest.update(data)
+                else:
+                    for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+                        digest.update(data[offset:offset + SAMPLE_SIZE])
+
+    return f"{size}:{digest.hexdigest()}"
+
+
+'''Fingerprints of the files in the libraries'''
+# Every library file is known by its size, its fingerprint is only read (and then kept) the first
+# time a new file of the same size turns up. Most new files share their size with nothing, so
+# checking them costs no reads at all. Files seen in the source this run are tracked the same way,
+# catching the same release downloaded twice; a long --watch run forgets them between batches.
+#
+# Each file is read at most once a run. Once read, it's filed under its fingerprint, so checking a
+# new file is one lookup rather than a pass over every file of its size.
+class FingerprintIndex:
+    def __init__(self, path=None):
+        self.path = path
+        # Library files are added from the transfer threads
+        self.lock = threading.RLock()
+        self.connection = None
+        # path -> (size, mtime_ns, fingerprint) as stored, for every library file. Loaded on first use.
+        self.records = None
+        # size -> library files
+        self.sizes = {}
+        # size -> library files whose fingerprint hasn't been read this run
+        self.unread = {}
+        # fingerprint -> library files read this run
+        self.values = {}
+        # size -> source files seen this run, and the ones among them not read yet
+        self.sources = {}
+        self.unread_sources = {}
+        # fingerprint -> source files read this run
+        self.source_values = {}
+        # path -> (size, mtime_ns, fingerprint), for source files read this run
+        self.read = {}
+
+    # The database is only opened once there's something to check, so an idle run never touches it
+    @property
+    def db(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path or fingerprint_file(), check_same_thread=False,
+                                              isolation_level=None, timeout=30)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def library_sizes(self):
+        with self.lock:
+            if self.records is None:
+                self.records = {}
+                for file_path, size, mtime_ns, value in self.db.execute("SELECT path, size, mtime_ns, fingerprint FROM files"):
+                    self.records[file_path] = (size, mtime_ns, value)
+                    self.sizes.setdefault(size, set()).add(file_path)
+                    self.unread.setdefault(size, set()).add(file_path)
+
+            return self.sizes
+
+    # Record a library file. Its fingerprint is read later, if it's ever needed.
+    def add(self, file_path, stat=None, value=None):
+        stat = stat or os.stat(file_path)
+
+        with self.lock:
+            self.forget_library(file_path)
+            self.records[file_path] = (stat.st_size, stat.st_mtime_ns, value)
+            self.sizes.setdefault(stat.st_size, set()).add(file_path)
+            if value is None:
+                self.unread.setdefault(stat.st_size, set()).add(file_path)
+            else:
+                self.values.setdefault(value, set()).add(file_path)
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                            (file_path, stat.st_size, stat.st_mtime_ns, value, time.time()))
+
+    # Record a library file placed from the source file `file_path`. Unless its data was changed on
+    # the way, it keeps the fingerprint the source was read with this run, so it's never read again.
+    def placed(self, file_path, new_path, changed=False):
+        stat = os.stat(new_path)
+        with self.lock:
+            known = None if changed else self.read.get(file_path)
+        value = known[2] if known and known[0] == stat.st_size else None
+        self.add(new_path, stat, value)
+
+    def remove(self, file_path):
+        with self.lock:
+            self.forget_library(file_path)
+            self.db.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+    # Drop a library file from the in-memory indexes, leaving the database alone
+    def forget_library(self, file_path):
+        self.library_sizes()
+        record = self.records.pop(file_path, None)
+        if record is None:
+            return
+
+        size, mtime_ns, value = record
+        for index, key in ((self.sizes, size), (self.unread, size), (self.values, value)):
+            if key in index:
+                index[key].discard(file_path)
+                if not index[key]:
+                    del index[key]
+
+    # A library file's fingerprint, read once and kept while the file is unchanged. None if it's gone.
+    def library_fingerprint(self, file_path):
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            self.remove(file_path)
+            return None
+
+        with self.lock:
+            self.library_sizes()
+            record = self.records.get(file_path)
+            if record and record[2] and record[:2] == (stat.st_size, stat.st_mtime_ns):
+                # Known from an earlier run, or read earlier in this one
+                if file_path in self.unread.get(stat.st_size, ()):
+                    self.unread[stat.st_size].discard(file_path)
+                    self.values.setdefault(record[2], set()).add(file_path)
+                return record[2]
+
+        value = fingerprint(file_path)
+        self.add(file_path, stat, value)
+        return value
+
+    # A source file's fingerprint, read once a run while the file is unchanged. None if it's gone,
+    # e.g. already moved.
+    def source_fingerprint(self, file_path):
+        try:
+            stat = os.stat(file_path)
+            with self.lock:
+                known = self.read.get(file_path)
+                if known is None or known[:2] != (stat.st_size, stat.st_mtime_ns):
+                    if known is not None:
+                        self.source_values[known[2]].remove(file_path)
+                    known = self.read[file_path] = (stat.st_size, stat.st_mtime_ns, fingerprint(file_path))
+                    self.source_values.setdefault(known[2], []).append(file_path)
+        except FileNotFoundError:
+            return None
+        return known[2]
+
+    # Forget the source files seen so far. Files already placed are still found through the library.
+    def forget(self):
+        with self.lock:
+            self.sources.clear()
+            self.unread_sources.clear()
+            self.source_values.clear()
+            self.read.clear()
+
+    # Read the files of this size that haven't been read yet, filing each under its fingerprint
+    def read_size(self, size):
+        for other in sorted(self.unread.get(size, ())):
+            self.library_fingerprint(other)
+        for other in self.unread_sources.pop(size, []):
+            self.source_fingerprint(other)
+
+    # The library file, or source file seen earlier in the run, that this one is identical to.
+    # None if there isn't one. With full set, a match is confirmed by hashing both files whole.
+    def duplicate(self, file_path, stat, full=False):
+        with self.lock:
+            original = None
+
+            if stat.st_size in self.library_sizes() or stat.st_size in self.sources:
+                self.read_size(stat.st_size)
+                value = self.source_fingerprint(file_path)
+
+                if value is not None:
+                    candidates = [(other, self.library_fingerprint) for other in sorted(self.values.get(value, ()))]
+                    candidates += [(other, self.source_fingerprint) for other in self.source_values.get(value, [])]
+
+                    # Still checked against the file on disk, in case it changed or went since it was read
+                    for other, other_fingerprint in candidates:
+                        if other != file_path and not same_file(other, stat) and other_fingerprint(other) == value:
+                            if not full or checksum(file_path) == checksum(other):
+                                original = other
+                                break
+
+                    # A duplicate is left where it is, later files are matched against the original
+                    if original is not None:
+                        self.source_values[value].remove(file_path)
+                        del self.read[file_path]
+            else:
+                self.unread_sources.setdefault(stat.st_size, []).append(file_path)
+
+            if original is None:
+                self.sources.setdefault(stat.st_size, []).append(file_path)
+            return original
+
+    # Is a source file the same as a library file? Compared by fingerprint, and whole when full is
+    # set. Files that can't be read aren't the same.
+    def identical(self, file_path, library_path, full=False):
+        try:
+            value = self.source_fingerprint(file_path)
+            if value is None or value != self.library_fingerprint(library_path):
+                return False
+            return not full or checksum(file_path) == checksum(library_path)
+        except OSError:
+            return False
+
+    # Bring the library records up to date with the files in `directories`: new and changed files
+    # are added, missing ones dropped. Returns how many were added and removed.
+    def scan(self, directories, extensions):
+        with self.lock:
+            rows = self.db.execute("SELECT path, size, mtime_ns FROM files").fetchall()
+        known = {file_path: (size, mtime_ns) for file_path, size, mtime_ns in rows}
+        found = set()
+        added = 0
+
+        for directory in directories:
+            for entry in scanner.scan(directory, extensions):
+                stat = entry.stat()
+                found.add(entry.path)
+                if known.get(entry.path) != (stat.st_size, stat.st_mtime_ns):
+                    self.add(entry.path, stat)
+                    added += 1
+
+        roots = tuple(os.path.join(directory, "") for directory in directories)
+        gone = [file_path for file_path in known if file_path.startswith(roots) and file_path not in found]
+        for file_path in gone:
+            self.remove(file_path)
+
+        return added, len(gone)
+
+    def stats(self):
+        with self.lock:
+            files, fingerprinted, size = self.db.execute("SELECT COUNT(*), COUNT(fingerprint), SUM(size) FROM files").fetchone()
+
+        return {'path': self.path or fingerprint_file(), 'files': files, 'fingerprinted': fingerprinted, 'size': size or 0}
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def checksum(file_path):
+    with metrics.timer("fingerprint"):
+        return transfer.checksum(file_path)
+
+
+# A hardlink of the source isn't a duplicate, it's the same file
+def same_file(file_path, stat):
+    try:
+        return os.path.samestat(os.stat(file_path), stat)
+    except FileNotFoundError:
+        return False
+
+
+# One index for the whole run, shared by the lookups and the transfer threads
+index = FingerprintIndex()
@@ -0,0 +1,106 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from preferences import paths
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS plan (
+    id INTEGER PRIMARY KEY,
+    file_path TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    tags TEXT,
+    source TEXT,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+'''
+
+# Status of a planned transfer
+PLANNED = "planned"
+DONE = "done"
+
+# A planned transfer. tags are the audiobook tag changes to write at the destination, or None.
+# source is the source directory the file was found in.
+Entry = namedtuple("Entry", "id file_path destination mode dev inode size mtime_ns tags source")
+
+# Enough of an os.stat_result for the state index, rebuilt from an entry
+Stat = namedtuple("Stat", "st_dev st_ino st_size st_mtime_ns")
+
+
+def journal_file():
+    return paths.app() / 'journal.sqlite'
+
+
+def entry_stat(entry):
+    return Stat(entry.dev, entry.inode, entry.size, entry.mtime_ns)
+
+
+'''Write-ahead journal of planned transfers'''
+# The whole plan is written, and synced to disk, before the first file is touched. Each transfer
+# is marked done as soon as it completes, so a run that's interrupted (Ctrl+C, a reboot, a full
+# disk) leaves behind exactly the transfers still to do, with everything needed to do them.
+class Journal:
+    def __init__(self, path=None):
+        self.path = path or journal_file()
+        # Entries are marked done from the transfer threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(SCHEMA)
+
+    # Add planned transfers in one transaction: (file_path, destination, mode, stat, tags, source) tuples.
+    # Returns them as entries.
+    def add(self, transfers):
+        entries = []
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            for file_path, destination, mode, stat, tags, source in transfers:
+                cursor = self.db.execute(
+                    "INSERT INTO plan (file_path, destination, mode, dev, inode, size, mtime_ns, tags, source, status, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (file_path, destination, mode, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                     json.dumps(tags) if tags else None, source, PLANNED, time.time()),
+                )
+                entries.append(Entry(cursor.lastrowid, file_path, destination, mode, stat.st_dev, stat.st_ino,
+                                     stat.st_size, stat.st_mtime_ns, tags, source))
+            self.db.execute("COMMIT")
+
+        return entries
+
+    # Transfers planned but not done yet, in the order they were planned
+    def pending(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, file_path, destination, mode, dev, inode, size, mtime_ns, tags, source FROM plan "
+                "WHERE status = ? ORDER BY id", (PLANNED,)
+            ).fetchall()
+
+        return [Entry(*row[:8], json.loads(row[8]) if row[8] else None, row[9]) for row in rows]
+
+    def done(self, entry_id):
+        with self.lock:
+            self.db.execute("UPDATE plan SET status = ?, updated = ? WHERE id = ?", (DONE, time.time(), entry_id))
+
+    # Drop an entry that can't be carried out any more
+    def drop(self, entry_id):
+        with self.lock:
+            self.db.execute("DELETE FROM plan WHERE id = ?", (entry_id,))
+
+    # Forget finished transfers. Once nothing is pending the journal is empty again.
+    def clear_done(self):
+        with self.lock:
+            self.db.execute("DELETE FROM plan WHERE status = ?", (DONE,))
+
+    def close(self):
+        self.db.close()
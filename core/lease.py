@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+
+# Seconds a lease lasts without being renewed. Holders renew every third of this.
+LEASE_TTL = 300
+# Leases live in this folder inside each source. Hidden, so never scanned.
+FOLDER = ".pybutler"
+
+
+def claims_dir(source):
+    return os.path.join(source, FOLDER, "claims")
+
+
+'''Leases on source files, for several hosts sharing one download folder'''
+# A host only processes the files it holds a lease on. A lease is a small file in the source's
+# claims folder named after the file's path relative to the source (so hosts may mount the share
+# in different places), created with O_EXCL, which only one host can win on a local disk or NFSv3+.
+# Leases are renewed in the background while their files are worked on and removed when each file
+# is done. A file that was placed but stays in the source (copied, linked, or already in the library)
+# keeps a marker with its size and mtime instead, so no other host takes it up again; a new file at
+# that path doesn't match the marker and is claimed as usual. Markers whose file has gone from the
+# source are cleared away on the first claim in a run, and again every `ttl` under --watch. A lease
+# left unrenewed for `ttl` belongs to a host that crashed, and may be taken over.
+# Until start() is called every claim succeeds, so a single host works as before.
+class Leases:
+    def __init__(self):
+        self.ttl = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        # file path -> (lease path, path relative to the source), for leases held by this process
+        self.held = {}
+        # source -> when its markers were last swept
+        self.swept = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.renewer = None
+
+    @property
+    def active(self):
+        return self.ttl is not None
+
+    def start(self, ttl=LEASE_TTL):
+        self.ttl = ttl
+        self.stopped.clear()
+        self.renewer = threading.Thread(target=self.renew, name="lease-renewer", daemon=True)
+        self.renewer.start()
+
+    def relative_path(self, file_path, source):
+        return os.path.relpath(file_path, source).replace(os.sep, "/")
+
+    def lease_path(self, file_path, source):
+        relative = self.relative_path(file_path, source)
+        return os.path.join(claims_dir(source), hashlib.sha1(relative.encode()).hexdigest() + ".lease")
+
+    def done_path(self, lease):
+        return lease[:-len(".lease")] + ".done"
+
+    # Has a host already placed this version of the file?
+    def finished(self, lease, stat):
+        try:
+            with open(self.done_path(lease)) as file:
+                marker = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        return (marker.get("size"), marker.get("mtime_ns")) == (stat.st_size, stat.st_mtime_ns)
+
+    # Take the lease on a file in `source`, as of `stat`. True if this process holds it now.
+    def claim(self, file_path, source, stat):
+        if not self.active:
+            return True
+
+        lease = self.lease_path(file_path, source)
+        os.makedirs(os.path.dirname(lease), exist_ok=True)
+
+        if time.time() - self.swept.get(source, 0) >= self.ttl:
+            self.sweep(source)
+
+        # A second try once a stale lease has been cleared away
+        for attempt in range(2):
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if attempt or not self.expire(lease):
+                    return False
+                continue
+
+            with os.fdopen(fd, "w") as file:
+                json.dump({"owner": self.owner, "file": file_path, "claimed": time.time()}, file)
+
+            # Checked once the lease is won: a host finishing with the file writes its marker before
+            # its lease goes, so a lease that's free by now comes with the marker
+            if self.finished(lease, stat):
+                os.unlink(lease)
+                return False
+
+            with self.lock:
+                self.held[file_path] = (lease, self.relative_path(file_path, source))
+            return True
+
+        return False
+
+    # Clear a lease that hasn't been renewed in time. True if it's gone.
+    def expire(self, lease):
+        try:
+            if time.time() - os.stat(lease).st_mtime < self.ttl:
+                return False
+        except FileNotFoundError:
+            return True
+
+        # Renamed aside first: when two hosts both find it stale, only one rename succeeds
+        stale = f"{lease}.{self.owner.replace(':', '-')}.stale"
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return True
+
+        try:
+            # Another host took it over between the check and the rename, hand it back
+            if time.time() - os.stat(stale).st_mtime < self.ttl:
+                try:
+                    os.link(stale, lease)
+                except OSError:
+                    pass
+                return False
+        finally:
+            os.unlink(stale)
+
+        return True
+
+    # Remove the markers of files that are no longer in `source`, e.g. deleted once they'd seeded
+    def sweep(self, source):
+        self.swept[source] = time.time()
+
+        try:
+            entries = list(os.scandir(claims_dir(source)))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if not entry.name.endswith(".done"):
+                continue
+
+            try:
+                with open(entry.path) as file:
+                    marker = json.load(file)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            # Markers from before the relative path was kept only have this host's view of the file
+            relative = marker.get("path")
+            if relative is None:
+                if not marker.get("file", "").startswith(os.path.join(source, "")):
+                    continue
+                relative = self.relative_path(marker["file"], source)
+
+            if not os.path.lexists(os.path.join(source, relative)):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    # Done with a file, whatever happened to it. `placed` when it's in the library now, so if it's
+    # still in the source the lease is swapped for a marker in one rename.
+    def release(self, file_path, placed=False):
+        with self.lock:
+            lease, relative = self.held.pop(file_path, (None, None))
+
+        if lease is None:
+            return
+
+        try:
+            stat = os.stat(file_path) if placed else None
+        except FileNotFoundError:
+            stat = None
+
+        try:
+            if stat is None:
+                os.unlink(lease)
+                return
+
+            with open(lease, "w") as file:
+                json.dump({"owner": self.owner, "file": file_path, "path": relative, "size": stat.st_size,
+                           "mtime_ns": stat.st_mtime_ns, "finished": time.time()}, file)
+            os.replace(lease, self.done_path(lease))
+        except FileNotFoundError:
+            # Taken over after this host stalled for longer than the TTL
+            pass
+
+    # Touch every held lease each third of the TTL, for as long as the run lasts
+    def renew(self):
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                leases = list(self.held.values())
+
+            for lease, relative in leases:
+                try:
+                    os.utime(lease)
+                except FileNotFoundError:
+                    # Taken over after this host stalled for longer than the TTL
+                    pass
+
+    # Stop renewing and give back every lease still held
+    def close(self):
+        if not self.active:
+            return
+
+        self.stopped.set()
+        for file_path in list(self.held):
+            self.release(file_path)
+        self.ttl = None
+
+
+# One set of leases for the whole run, shared by the scan, the lookups and the transfer threads
+leases = Leases()
@@ -0,0 +1,114 @@
+import os
+import threading
+
+
+# Why a destination can't be used
+EXISTS = "exists"   # the library already has a file by that name
+CLAIMED = "claimed" # another file in this run is already headed there
+
+'''Destination library index'''
+# What's in the library folders, listed with one os.scandir the first time a file is headed for a
+# folder and kept up to date as files arrive. Answers "does this exist" from memory, which matters
+# on network mounts where every stat is a round trip, creates each folder once, and catches two
+# files headed for the same name before either of them is moved.
+class LibraryIndex:
+    def __init__(self):
+        # Folders are created from the transfer threads, claims made from the lookup threads
+        self.lock = threading.RLock()
+        # folder -> names in it, or None for folders that don't exist
+        self.folders = {}
+        # destination -> source, for files headed into the library this run
+        self.claims = {}
+
+    # Names in a folder, listed on first use. A folder under one known not to exist isn't listed at all.
+    def listing(self, folder):
+        with self.lock:
+            if folder not in self.folders:
+                parent = os.path.dirname(folder)
+                siblings = self.folders.get(parent, ()) if parent != folder else ()
+
+                if siblings is None or (parent in self.folders and os.path.basename(folder) not in siblings):
+                    self.folders[folder] = None
+                else:
+                    self.folders[folder] = scan(folder)
+
+            return self.folders[folder]
+
+    def exists(self, path):
+        path = os.path.normpath(path)
+        names = self.listing(os.path.dirname(path))
+        return names is not None and os.path.basename(path) in names
+
+    # os.makedirs(), skipping folders already there or already created this run
+    def makedirs(self, folder):
+        folder = os.path.normpath(folder)
+
+        with self.lock:
+            if self.listing(folder) is not None:
+                return
+
+            parent = os.path.dirname(folder)
+            if parent != folder:
+                self.makedirs(parent)
+
+            try:
+                os.mkdir(folder)
+            except FileExistsError:
+                pass
+
+            self.folders[folder] = set()
+            self.add(folder)
+
+    # Reserve a destination for a source file. Returns None once it's reserved, otherwise why it
+    # can't be: EXISTS or CLAIMED.
+    def claim(self, path, source):
+        path = os.path.normpath(path)
+
+        with self.lock:
+            if self.claims.get(path, source) != source:
+                return CLAIMED
+            if self.exists(path):
+                return EXISTS
+
+            self.claims[path] = source
+
+    # A file (or folder) is now in the library
+    def add(self, path):
+        path = os.path.normpath(path)
+
+        with self.lock:
+            names = self.listing(os.path.dirname(path))
+            if names is not None:
+                names.add(os.path.basename(path))
+            self.claims.pop(path, None)
+
+    # A file is no longer in the library
+    def remove(self, path):
+        path = os.path.normpath(path)
+
+        with self.lock:
+            names = self.folders.get(os.path.dirname(path))
+            if names is not None:
+                names.discard(os.path.basename(path))
+
+    # A claimed file didn't make it, its destination is free again
+    def release(self, path):
+        with self.lock:
+            self.claims.pop(os.path.normpath(path), None)
+
+    # Forget the listings, so the next lookups see changes made outside pyButler. Claims are kept.
+    def refresh(self):
+        with self.lock:
+            self.folders.clear()
+
+
+def scan(folder):
+    try:
+        with os.scandir(folder) as entries:
+            return {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+# One index for the whole run, shared by the lookups and the transfer threads
+index = LibraryIndex()
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Stages timed across a run, in the order a file goes through them
+STAGES = ("fingerprint", "probe", "parse", "tmdb", "tagging", "directories", "transfer")
+
+'''Run metrics'''
+# Time spent in each stage (calls, total and slowest seconds) and plain counters such as cache
+# hits or bytes moved. Shared by every thread, the plugins and the client report into `registry`.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+            self.counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            calls, total, slowest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (calls + 1, total + seconds, max(slowest, seconds))
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            stages = {stage: {"calls": calls, "seconds": total, "max_seconds": slowest}
+                      for stage, (calls, total, slowest) in self.stages.items()}
+            return {"started": self.started, "seconds": time.time() - self.started,
+                    "stages": stages, "counters": dict(self.counters)}
+
+
+registry = Metrics()
+timer = registry.timer
+count = registry.count
+
+
+# Stages in pipeline order, then anything else that was timed
+def ordered(stages):
+    return sorted(stages.items(), key=lambda item: (STAGES.index(item[0]) if item[0] in STAGES else len(STAGES), item[0]))
+
+
+# One line per stage and counter, for the end of a run
+def summary(snapshot):
+    lines = []
+
+    for stage, stage_stats in ordered(snapshot["stages"]):
+        average = stage_stats["seconds"] / stage_stats["calls"] * 1000
+        lines.append(f"{stage:<14} {stage_stats['calls']:>7} calls {stage_stats['seconds']:>9.2f}s "
+                     f"(avg {average:.1f} ms, max {stage_stats['max_seconds'] * 1000:.1f} ms)")
+
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f"{name:<14} {value:>7}")
+
+    return lines
+
+
+def prometheus(snapshot):
+    lines = [
+        "# HELP pybutler_stage_seconds_total Time spent in each stage of the last run.",
+        "# TYPE pybutler_stage_seconds_total counter",
+    ]
+    stages = ordered(snapshot["stages"])
+    lines += [f'pybutler_stage_seconds_total{{stage="{stage}"}} {stage_stats["seconds"]:.6f}' for stage, stage_stats in stages]
+
+    lines += ["# HELP pybutler_stage_calls_total Times each stage ran in the last run.", "# TYPE pybutler_stage_calls_total counter"]
+    lines += [f'pybutler_stage_calls_total{{stage="{stage}"}} {stage_stats["calls"]}' for stage, stage_stats in stages]
+
+    lines += ["# HELP pybutler_stage_max_seconds Slowest single call of each stage in the last run.", "# TYPE pybutler_stage_max_seconds gauge"]
+    lines += [f'pybutler_stage_max_seconds{{stage="{stage}"}} {stage_stats["max_seconds"]:.6f}' for stage, stage_stats in stages]
+
+    for name, value in sorted(snapshot["counters"].items()):
+        lines += [f"# TYPE pybutler_{name}_total counter", f"pybutler_{name}_total {value}"]
+
+    lines += [
+        "# TYPE pybutler_run_seconds gauge", f"pybutler_run_seconds {snapshot['seconds']:.3f}",
+        "# TYPE pybutler_last_run_timestamp_seconds gauge", f"pybutler_last_run_timestamp_seconds {snapshot['started']:.0f}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+# Write a snapshot as a Prometheus textfile (for the node exporter's textfile collector) when the
+# file ends in .prom, JSON otherwise. Written aside and renamed, so a scrape never sees half a file.
+def write(snapshot, file_path):
+    if str(file_path).endswith(".prom"):
+        content = prometheus(snapshot)
+    else:
+        content = json.dumps(snapshot, indent=2) + "\n"
+
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "w") as file:
+        file.write(content)
+    os.replace(temp_path, file_path)
@@ -0,0 +1,92 @@
+import os
+import re
+from collections import namedtuple
+
+
+# kind:       "episode", "movie" or "unknown"
+# title:      the name before the first marker, separators turned into spaces
+# year:       int or None. For episodes, only a year sitting right before SxxEyy counts.
+# season:     int or None
+# episodes:   list of ints, more than one for multi-episode files (S01E01E02, S01E01-E02)
+# resolution: e.g. "1080p", lowercased, or None
+# tags:       release tags found in the name, lowercased (bluray, x265, ...)
+ParsedName = namedtuple("ParsedName", "kind title year season episodes resolution tags extension")
+
+RELEASE_TAGS = (
+    r"blu-?ray|bdrip|brrip|bdremux|remux|web-?dl|web-?rip|webrip|web|hdtv|hdrip|dvdrip|dvdscr|hdcam|"
+    r"x264|x265|h\.?264|h\.?265|hevc|avc|xvid|10bit|hdr10|hdr|dv|"
+    r"aac(?:2\.0)?|ac3|eac3|dts(?:-hd)?|truehd|atmos|ddp?5\.1|dd2\.0|"
+    r"proper|repack|extended|unrated|remastered|imax|internal|limited"
+)
+
+# Everything the parser looks for, in one pattern, so a name is scanned exactly once
+TOKENS = re.compile(rf"""
+    (?P<episode>S(?P<season>\d{{1,3}})(?P<numbers>(?:[ ._-]?E\d{{1,4}})+))
+  | (?P<year>(?<![a-z0-9])(?:19|20)\d{{2}}(?![a-z0-9]))
+  | (?P<resolution>(?<![a-z0-9])(?:\d{{3,4}}[pi]|4k|uhd)(?![a-z0-9]))
+  | (?P<tag>(?<![a-z0-9])(?:{RELEASE_TAGS})(?![a-z0-9]))
+""", re.IGNORECASE | re.VERBOSE)
+
+NUMBER = re.compile(r"\d+")
+SEPARATORS = re.compile(r"[._()\[\]{}]")
+JOINERS = re.compile(r"[^\w]*$")
+# Release group prefix: "[Group] Movie Name"
+GROUP = re.compile(r"^\s*\[[^\]]*\]")
+
+
+# "Cool.Show.-." -> "Cool Show". Hyphens inside words (Spider-Man) are kept.
+def clean_title(text):
+    words = (word.strip("-") for word in SEPARATORS.sub(" ", text).split())
+    return " ".join(word for word in words if word)
+
+
+def parse(file_name):
+    name, extension = os.path.splitext(file_name)
+    episode = None
+    years = []
+    resolutions = []
+    tags = []
+
+    for match in TOKENS.finditer(name):
+        token = match.lastgroup
+
+        if token == 'episode':
+            # Only the first SxxEyy counts, later ones are part of the release name
+            episode = episode or match
+        elif token == 'year':
+            years.append(match)
+        elif token == 'resolution':
+            resolutions.append(match)
+        else:
+            tags.append(match)
+
+    if episode is not None:
+        kind = "episode"
+        season = int(episode.group('season'))
+        episodes = [int(number) for number in NUMBER.findall(episode.group('numbers'))]
+        title_end = episode.start()
+        year = None
+
+        # A year counts when only separators sit between it and SxxEyy: "Show (2019) S01E01"
+        before = [match for match in years if match.end() <= episode.start()]
+        if before and before[-1].start() > 0 and not JOINERS.sub("", name[before[-1].end():episode.start()]):
+            year = int(before[-1].group())
+            title_end = before[-1].start()
+
+    else:
+        kind = "movie" if years else "unknown"
+        season = None
+        episodes = []
+        # The last year wins, so titles with a year in them still parse: "Blade Runner 2049 (2017)".
+        # A resolution is never part of a title, so the title also stops at one.
+        title_end = min([match.start() for match in years[-1:] + resolutions[:1]] or [len(name)])
+        year = int(years[-1].group()) if years else None
+
+    # Release info only counts once the title is over, words like "Web" or "Proper" can be titles
+    resolution = next((match.group().lower() for match in resolutions if match.start() >= title_end), None)
+    tags = [match.group().lower() for match in tags if match.start() >= title_end]
+
+    group = GROUP.match(name)
+    title_start = group.end() if group and group.end() < title_end else 0
+
+    return ParsedName(kind, clean_title(name[title_start:title_end]), year, season, episodes, resolution, tags, extension)
@@ -0,0 +1,304 @@
+import os
+import struct
+from collections import namedtuple
+
+from core import metrics
+
+
+# width and height in pixels, codec as a short label (HEVC, AVC...), any of them None if unknown
+MediaInfo = namedtuple("MediaInfo", "width height codec")
+
+# Matroska element IDs
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEKHEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEKID = 0x53AB
+SEEKPOSITION = 0x53AC
+TRACKS = 0x1654AE6B
+TRACKENTRY = 0xAE
+TRACKTYPE = 0x83
+CODECID = 0x86
+VIDEO = 0xE0
+PIXELWIDTH = 0xB0
+PIXELHEIGHT = 0xBA
+CLUSTER = 0x1F43B675
+
+# Header elements bigger than this aren't headers, the file is damaged or not what it claims to be
+MAX_HEADER = 16 * 1024 * 1024
+
+MKV_CODECS = {
+    "V_MPEGH/ISO/HEVC": "HEVC", "V_MPEG4/ISO/AVC": "AVC", "V_AV1": "AV1", "V_VP9": "VP9", "V_VP8": "VP8",
+    "V_MPEG4/ISO/ASP": "MPEG4", "V_MPEG4/ISO/SP": "MPEG4", "V_MS/VFW/FOURCC": "VFW", "V_MPEG2": "MPEG2",
+}
+
+MP4_CODECS = {
+    b"hvc1": "HEVC", b"hev1": "HEVC", b"dvh1": "HEVC", b"dvhe": "HEVC", b"avc1": "AVC", b"avc3": "AVC",
+    b"av01": "AV1", b"vp09": "VP9", b"mp4v": "MPEG4",
+}
+
+# Smallest frame size for each label, with some slack for cropped releases (1920x800 is still 1080p)
+RESOLUTIONS = (("2160p", 3840, 2160), ("1080p", 1920, 1080), ("720p", 1280, 720), ("576p", 720, 576))
+
+
+'''Read a video's resolution and codec from its headers'''
+# Only the container headers are read: Matroska's Tracks element (found through the SeekHead when
+# it comes after the clusters) and the moov/trak boxes of an MP4, skipping over everything else.
+# A few small reads per file, however big it is. Returns a MediaInfo, or None for other files.
+def probe(file_path):
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        start = file.read(8)
+
+        if start[:4] == EBML.to_bytes(4, 'big'):
+            return probe_mkv(file, size)
+        if start[4:8] == b"ftyp":
+            return probe_mp4(file, size)
+
+    return None
+
+
+# "1080p HEVC" for a file, or None if it can't be probed. Used for file names.
+def quality(file_path):
+    try:
+        with metrics.timer("probe"):
+            info = probe(file_path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+    if info is None:
+        return None
+
+    parts = [resolution(info.width, info.height), info.codec]
+    return " ".join(part for part in parts if part) or None
+
+
+def resolution(width, height):
+    if not width or not height:
+        return None
+
+    for label, min_width, min_height in RESOLUTIONS:
+        if width >= min_width * 0.9 or height >= min_height * 0.9:
+            return label
+
+    return "480p"
+
+
+def read_exact(file, size):
+    data = file.read(size)
+    if len(data) < size:
+        raise ValueError("file is truncated")
+    return data
+
+
+# Matroska
+
+# Element IDs keep their length marker bits, sizes don't. None is an unknown size.
+def read_vint(file, max_length, keep_marker):
+    first = read_exact(file, 1)[0]
+    length = 1
+    while length <= max_length and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > max_length:
+        raise ValueError("invalid EBML number")
+
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in read_exact(file, length - 1):
+        value = (value << 8) | byte
+
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None
+    return value
+
+
+# (id, data start, data size) for each element from the file's position up to `end`. Elements of
+# unknown size can't be skipped, so the walk stops after one.
+def elements(file, end):
+    position = file.tell()
+
+    while position < end:
+        file.seek(position)
+        element_id = read_vint(file, 4, True)
+        size = read_vint(file, 8, False)
+        start = file.tell()
+
+        yield element_id, start, size
+
+        if size is None:
+            return
+        position = start + size
+
+
+def read_uint(file, start, size):
+    file.seek(start)
+    return int.from_bytes(read_exact(file, min(size, 8)), 'big')
+
+
+def read_string(file, start, size):
+    file.seek(start)
+    return read_exact(file, min(size, 256)).rstrip(b"\0").decode('ascii', 'replace')
+
+
+def probe_mkv(file, file_size):
+    file.seek(0)
+    read_vint(file, 4, True)
+    file.seek(read_vint(file, 8, False) or 0, os.SEEK_CUR)
+
+    if read_vint(file, 4, True) != SEGMENT:
+        return None
+    size = read_vint(file, 8, False)
+    segment = file.tell()
+    end = file_size if size is None else min(file_size, segment + size)
+    tracks = None
+
+    for element_id, start, size in elements(file, end):
+        if element_id == TRACKS:
+            return mkv_tracks(file, start, start + check_size(size))
+        elif element_id == SEEKHEAD:
+            tracks = mkv_seek(file, start, start + check_size(size), TRACKS)
+        elif element_id == CLUSTER:
+            break
+
+    # Tracks written after the clusters, the SeekHead says where
+    if tracks is not None:
+        file.seek(segment + tracks)
+        if read_vint(file, 4, True) == TRACKS:
+            size = check_size(read_vint(file, 8, False))
+            start = file.tell()
+            return mkv_tracks(file, start, start + size)
+
+    return None
+
+
+def check_size(size):
+    if size is None or size > MAX_HEADER:
+        raise ValueError("header element is too big")
+    return size
+
+
+# Position of a top level element, relative to the segment, from a SeekHead
+def mkv_seek(file, start, end, wanted):
+    for element_id, seek_start, seek_size in elements_at(file, start, end):
+        if element_id != SEEK:
+            continue
+
+        seek_id = position = None
+        for child_id, child_start, child_size in elements_at(file, seek_start, seek_start + seek_size):
+            if child_id == SEEKID:
+                seek_id = read_uint(file, child_start, child_size)
+            elif child_id == SEEKPOSITION:
+                position = read_uint(file, child_start, child_size)
+
+        if seek_id == wanted:
+            return position
+
+    return None
+
+
+# The first video track's size and codec
+def mkv_tracks(file, start, end):
+    for element_id, entry_start, entry_size in elements_at(file, start, end):
+        if element_id != TRACKENTRY:
+            continue
+
+        track_type = codec = width = height = None
+        for child_id, child_start, child_size in elements_at(file, entry_start, entry_start + entry_size):
+            if child_id == TRACKTYPE:
+                track_type = read_uint(file, child_start, child_size)
+            elif child_id == CODECID:
+                codec = read_string(file, child_start, child_size)
+            elif child_id == VIDEO:
+                for video_id, video_start, video_size in elements_at(file, child_start, child_start + child_size):
+                    if video_id == PIXELWIDTH:
+                        width = read_uint(file, video_start, video_size)
+                    elif video_id == PIXELHEIGHT:
+                        height = read_uint(file, video_start, video_size)
+
+        # Track type 1 is video
+        if track_type == 1:
+            return MediaInfo(width, height, MKV_CODECS.get(codec))
+
+    return None
+
+
+def elements_at(file, start, end):
+    file.seek(start)
+    return elements(file, end)
+
+
+# MP4
+
+# (type, data start, end) for each box between start and end
+def boxes(file, start, end):
+    position = start
+
+    while position + 8 <= end:
+        file.seek(position)
+        size, kind = struct.unpack(">I4s", read_exact(file, 8))
+        header = 8
+
+        if size == 1:
+            size = struct.unpack(">Q", read_exact(file, 8))[0]
+            header = 16
+        elif size == 0:
+            # Runs to the end of the file
+            size = end - position
+
+        if size < header:
+            return
+
+        yield kind, position + header, position + size
+        position += size
+
+
+# (start, end) of the box at the end of a path, e.g. (b"mdia", b"hdlr"), or None
+def find_box(file, start, end, *path):
+    for kind, box_start, box_end in boxes(file, start, end):
+        if kind == path[0]:
+            return (box_start, box_end) if len(path) == 1 else find_box(file, box_start, box_end, *path[1:])
+
+    return None
+
+
+def read_at(file, position, size):
+    file.seek(position)
+    return read_exact(file, size)
+
+
+# moov may come before or after the media data, either way only its boxes are read
+def probe_mp4(file, file_size):
+    moov = find_box(file, 0, file_size, b"moov")
+    if moov is None:
+        return None
+
+    for kind, start, end in boxes(file, *moov):
+        if kind == b"trak":
+            info = mp4_track(file, start, end)
+            if info is not None:
+                return info
+
+    return None
+
+
+def mp4_track(file, start, end):
+    # The handler says what kind of track this is
+    hdlr = find_box(file, start, end, b"mdia", b"hdlr")
+    if hdlr is None or read_at(file, hdlr[0] + 8, 4) != b"vide":
+        return None
+
+    codec = width = height = None
+
+    # The first sample description: version and entry count, then the entry's size and format,
+    # with the coded width and height 32 bytes into the entry
+    stsd = find_box(file, start, end, b"mdia", b"minf", b"stbl", b"stsd")
+    if stsd is not None and stsd[1] - stsd[0] >= 44:
+        description = read_at(file, stsd[0], 44)
+        codec = MP4_CODECS.get(description[12:16])
+        width, height = struct.unpack(">HH", description[40:44])
+
+    # Otherwise the display size from the track header, 16.16 fixed point at its end
+    tkhd = find_box(file, start, end, b"tkhd")
+    if not (width and height) and tkhd is not None and tkhd[1] - tkhd[0] >= 8:
+        width, height = (value >> 16 for value in struct.unpack(">II", read_at(file, tkhd[1] - 8, 8)))
+
+    return MediaInfo(width, height, codec)
@@ -0,0 +1,110 @@
+import math
+import re
+import threading
+
+from core.titles import normalize_title
+
+
+# Sequel markers have to agree exactly, "Saw II" is not a near miss for "Saw III"
+NUMBERS = re.compile(r"^(\d+|i{1,3}|iv|v|vi{1,3}|ix|x)$")
+
+
+def trigrams(norm):
+    padded = f"  {norm} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def numbers(norm):
+    return {token for token in norm.split() if NUMBERS.match(token)}
+
+# 0..1, how alike two normalised titles are by whole words and by letter trigrams
+def similarity(a, b):
+    if a == b:
+        return 1.0
+    if numbers(a) != numbers(b):
+        return 0.0
+
+    return 0.5 * jaccard(set(a.split()), set(b.split())) + 0.5 * jaccard(trigrams(a), trigrams(b))
+
+
+# Names and year of a TMDB search result, for movies and shows alike
+def result_titles(result):
+    return [result[field] for field in ("title", "name", "original_title", "original_name") if result.get(field)]
+
+
+def result_year(result):
+    year = (result.get("release_date") or result.get("first_air_date") or "")[:4]
+    return int(year) if year.isdigit() else None
+
+
+'''Score a search result against the title and year parsed from the file name'''
+#   title:      best similarity of the result's title or original title      (weight 0.65)
+#   year:       exact 1, a year out 0.5 (festival vs release dates), else 0  (weight 0.25)
+#   popularity: log scaled, only really matters between otherwise equal hits (weight 0.10)
+def score(result, title, year=None):
+    norm = normalize_title(title)
+    title_score = max((similarity(norm, normalize_title(name)) for name in result_titles(result)), default=0.0)
+
+    found_year = result_year(result)
+    if not year or found_year is None:
+        year_score = 0.5
+    else:
+        year_score = {0: 1.0, 1: 0.5}.get(abs(int(year) - found_year), 0.0)
+
+    popularity_score = min(math.log1p(result.get("popularity") or 0) / math.log1p(1000), 1.0)
+
+    return 0.65 * title_score + 0.25 * year_score + 0.10 * popularity_score
+
+# Search results sorted best match first
+def rank(results, title, year=None):
+    return sorted(results, key=lambda result: score(result, title, year), reverse=True)
+
+
+def best(results, title, year=None):
+    return max(results, key=lambda result: score(result, title, year)) if results else None
+
+
+'''In-memory index of titles already resolved'''
+# Filled with the result each search resolved to, from the metadata cache and from every new search
+# as it comes back, so the same title spelled another way ("Show.Name.2019", "show name (2019)")
+# resolves without the API. Only exact matches of the normalised title count: a near miss may well
+# be another title ("Saw II", "Harbor Winter Harbor"), and goes to TMDB and best() like any search.
+class ResolvedTitles:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (kind, normalised query, year or None) -> the result the search resolved to
+        self.queries = {}
+        # (kind, normalised title, year) -> {id: result}, by each of a result's titles
+        self.titles = {}
+
+    def add(self, kind, query, year, result):
+        year = int(year) if year else None
+
+        with self.lock:
+            self.queries.setdefault((kind, normalize_title(query), year), result)
+
+            found_year = result_year(result)
+            if found_year is None:
+                return
+            for name in result_titles(result):
+                self.titles.setdefault((kind, normalize_title(name), found_year), {})[result.get("id")] = result
+
+    # The result for `title`, or None to ask TMDB. A search made before answers a repeat of itself.
+    # With a year, a result of exactly that title and year answers too; without one it can't, as
+    # which year a bare title resolves to depends on every result TMDB has for it, not just the ones
+    # seen so far. Titles of the same name and year are told apart the way best() does, then by id.
+    def match(self, kind, title, year=None):
+        norm = normalize_title(title)
+        year = int(year) if year else None
+
+        with self.lock:
+            result = self.queries.get((kind, norm, year))
+            if result is not None or year is None:
+                return result
+            results = list(self.titles.get((kind, norm, year), {}).values())
+
+        return max(results, key=lambda result: (score(result, title, year), -(result.get("id") or 0)), default=None)
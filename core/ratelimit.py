@@ -0,0 +1,75 @@
+import random
+import threading
+import time
+
+
+# TMDB allows around 40 requests a second from one address
+RATE_LIMIT = 40
+RETRIES = 4
+# Backoff before each retry: 0.5s, 1s, 2s, 4s... plus up to half again at random, capped
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+# Answers worth asking again for, everything else is final
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+'''Token bucket'''
+# Spreads requests from every worker to `rate` a second, allowing bursts of up to `rate`.
+# reserve() takes a token and returns how long to wait before using it, so it works for
+# threads (time.sleep) and coroutines (asyncio.sleep) alike.
+class TokenBucket:
+    def __init__(self, rate=RATE_LIMIT, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # No tokens are handed out before this, set when the server says to back off
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+
+            # Without a rate there are no tokens to count, but a pause still holds everyone back
+            if not self.rate:
+                return max(0.0, self.paused_until - now)
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            # A negative balance is a queue of waiting requests, each a 1/rate slot later
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    # Hold every request back for `seconds`, e.g. after a 429
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# Seconds from a Retry-After header, given either as seconds or as an HTTP date. None if missing or invalid.
+def retry_after(value):
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# How long to wait before retry number `attempt` (0 based). The server's Retry-After wins when given.
+def backoff(attempt, server_delay=None):
+    if server_delay is not None:
+        return min(server_delay, MAX_BACKOFF)
+
+    delay = BACKOFF * 2 ** attempt
+    return min(delay + random.uniform(0, delay / 2), MAX_BACKOFF)
@@ -0,0 +1,34 @@
+import json
+import sys
+import threading
+import time
+
+
+# Outcomes reported for a file
+MOVED = "moved"
+FAILED = "failed"
+RETRY = "retry"
+ERROR = "error"
+SKIPPED = "skipped"
+# --dry-run: where the file would go
+PLANNED = "planned"
+# Left in place: the library already has this file, or a different one by the same name
+DUPLICATE = "duplicate"
+CONFLICT = "conflict"
+
+'''JSON lines output'''
+# One JSON object per line and per file, for scripts driving pyButler with --batch. Written from
+# the lookup and transfer threads alike, each line is written and flushed whole.
+class JsonLines:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def write(self, status, file_path, source=None, **fields):
+        record = {"time": round(time.time(), 3), "status": status, "file": file_path, "source": source}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False)
+
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
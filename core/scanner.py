@@ -0,0 +1,77 @@
+import fnmatch
+import os
+from itertools import islice
+
+
+# Does a file or directory match any of the glob patterns? Checked against both
+# the path relative to the source directory and the bare name.
+def matches(relative_path, name, patterns):
+    return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+'''Stream the supported files in a source directory'''
+# Yields an os.DirEntry for each file as soon as it is found, so processing can start before
+# the walk is finished. DirEntry caches its own stat data, use entry.stat() rather than os.stat().
+#   depth:   how many levels of sub-directories to descend into (0 = top level only, None = no limit)
+#   include: if given, only files matching one of these globs are yielded
+#   exclude: files and directories matching these globs are skipped
+#   skip:    directories never to descend into, e.g. target folders that live inside the source
+# Hidden files and folders (starting with '.') and symlinked folders are always skipped.
+def scan(root, extensions, depth=None, include=(), exclude=(), skip=()):
+    skip = {os.path.realpath(directory) for directory in skip}
+    yield from walk(root, "", extensions, depth, include, exclude, skip)
+
+
+def walk(directory, relative, extensions, depth, include, exclude, skip):
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            relative_path = relative + entry.name
+            if matches(relative_path, entry.name, exclude):
+                continue
+
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_file = not is_dir and entry.is_file()
+            except OSError:
+                continue
+
+            if is_dir:
+                if (depth is None or depth > 0) and os.path.realpath(entry.path) not in skip:
+                    sub_depth = None if depth is None else depth - 1
+                    yield from walk(entry.path, relative_path + "/", extensions, sub_depth, include, exclude, skip)
+
+            elif is_file and os.path.splitext(entry.name)[1] in extensions:
+                if not include or matches(relative_path, entry.name, include):
+                    yield entry
+
+
+# Is the path, or any folder it sits in, hidden or excluded?
+def excluded(relative_path, exclude=()):
+    parts = relative_path.replace(os.sep, '/').split('/')
+    return any(part.startswith('.') or matches('/'.join(parts[:level + 1]), part, exclude) for level, part in enumerate(parts))
+
+
+# Would scan() yield this file? For paths reported by something other than a walk, like the watcher.
+def wanted(relative_path, extensions, include=(), exclude=()):
+    if excluded(relative_path, exclude) or os.path.splitext(relative_path)[1] not in extensions:
+        return False
+
+    return not include or matches(relative_path.replace(os.sep, '/'), os.path.basename(relative_path), include)
+
+
+# Split a stream into lists of up to `size` items, without reading ahead further than that
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,70 @@
+import errno
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.transfer import existing_parent, format_size
+
+
+'''Run transfers in the background, grouped by the device they write to'''
+# Each destination device (the movie, show and audiobook folders may sit on different disks) gets
+# its own queue and `per_device` worker threads, so a long copy to one disk never holds up
+# another, and one disk is never thrashed by more than `per_device` copies at once.
+# Free space is checked when a transfer is queued, counting everything already queued for that
+# device, so a full disk fails straight away instead of halfway through a copy.
+# Nobody waits on the futures, so an exception a task raises is logged here and handed to the
+# `failed` callback it was queued with, rather than lost with the future.
+class Scheduler:
+    def __init__(self, per_device=1, logger=None):
+        self.per_device = per_device
+        self.logger = logger
+        # st_dev -> ThreadPoolExecutor
+        self.pools = {}
+        # st_dev -> bytes that queued transfers are going to write
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    # Queue task() to run on the worker for dst's device. `space` is how many bytes it will write.
+    # Raises OSError(ENOSPC) if the device can't fit it. failed(exception) is called if task() raises.
+    def submit(self, dst, space, task, failed=None):
+        directory = existing_parent(os.path.dirname(dst))
+        device = os.stat(directory).st_dev
+
+        with self.lock:
+            if space:
+                free = shutil.disk_usage(directory).free - self.reserved.get(device, 0)
+                if space > free:
+                    raise OSError(errno.ENOSPC, f"Not enough space for {os.path.basename(dst)}: "
+                                                f"needs {format_size(space)}, {format_size(max(free, 0))} free", dst)
+
+            self.reserved[device] = self.reserved.get(device, 0) + space
+
+            if device not in self.pools:
+                self.pools[device] = ThreadPoolExecutor(max_workers=self.per_device, thread_name_prefix=f"transfer-{device}")
+
+            return self.pools[device].submit(self.run, device, space, task, dst, failed)
+
+    def run(self, device, space, task, dst, failed=None):
+        try:
+            return task()
+        except Exception as e:
+            if self.logger:
+                self.logger.exception("Transfer to %s failed", dst)
+            if failed:
+                failed(e)
+        finally:
+            with self.lock:
+                self.reserved[device] -= space
+
+    # Wait for every queued transfer to finish
+    def join(self):
+        for pool in list(self.pools.values()):
+            pool.shutdown(wait=True)
+        self.pools.clear()
+
+    # Drop queued transfers and let the ones already running finish
+    def cancel(self):
+        for pool in list(self.pools.values()):
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.pools.clear()
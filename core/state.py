@@ -0,0 +1,69 @@
+import sqlite3
+import threading
+import time
+
+from preferences import paths
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (dev, inode)
+);
+'''
+
+# Outcomes recorded for a source file
+MOVED = "moved"
+FAILED = "failed"
+
+
+def state_file():
+    return paths.app() / 'state.sqlite'
+
+
+'''What happened to each source file on previous runs'''
+# Files are identified by (device, inode) and only count as unchanged while their size and
+# mtime still match, so a re-downloaded or edited file is always looked at again.
+# The whole index is held in memory for O(1) checks; every change is written straight to disk.
+class StateIndex:
+    def __init__(self, path=None):
+        self.path = path or state_file()
+        # Outcomes are recorded from the transfer threads as well as the main thread
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.executescript(SCHEMA)
+
+        rows = self.db.execute("SELECT dev, inode, size, mtime_ns, outcome FROM files")
+        self.known = {(dev, inode): (size, mtime_ns, outcome) for dev, inode, size, mtime_ns, outcome in rows}
+
+    # The recorded outcome for an unchanged file, or None if it is new or has changed
+    def outcome(self, stat):
+        known = self.known.get((stat.st_dev, stat.st_ino))
+        if known is None or known[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+
+        return known[2]
+
+    # Should this file be skipped? Failures are retried when retry_failed is set.
+    def skip(self, stat, retry_failed=False):
+        outcome = self.outcome(stat)
+        return outcome == MOVED or (outcome == FAILED and not retry_failed)
+
+    def record(self, stat, file_path, outcome):
+        key = (stat.st_dev, stat.st_ino)
+
+        with self.lock:
+            self.known[key] = (stat.st_size, stat.st_mtime_ns, outcome)
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, stat.st_size, stat.st_mtime_ns, str(file_path), outcome, time.time()),
+            )
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,46 @@
+from core import metrics
+
+
+'''Tag changes waiting for their file to reach its destination'''
+# Plugins only read tags during the lookup. Any changes are kept here, by source path, and written
+# once the file has been moved, so the source is never rewritten and each file is written at most
+# once. They live outside the plugins so moving a file never has to import one.
+# source path -> {tag: value}
+pending = {}
+
+
+# A file's tags, read with the mutagen reader for its format (picked from its extension and
+# header). The tags have the same names whatever the format: 'title', 'album', 'artist'...
+# None if mutagen has no reader for it.
+def read(file_path):
+    # Imported on the first file with tags, most runs have none
+    import mutagen
+
+    return mutagen.File(file_path, easy=True)
+
+
+def has_pending(file_path):
+    return file_path in pending
+
+
+# Write the tag changes waiting for file_path into the file at new_path. Returns whether there
+# were any; raises if they can't be written.
+def write(file_path, new_path):
+    changes = pending.pop(file_path, None)
+    if not changes:
+        return False
+
+    with metrics.timer("tagging"):
+        audio = read(new_path)
+        if audio is None:
+            raise ValueError("unknown format")
+        for tag, value in changes.items():
+            audio[tag] = value
+        audio.save()
+
+    return True
+
+
+# Drop the tag changes for a file that didn't make it to its destination
+def discard(file_path):
+    pending.pop(file_path, None)
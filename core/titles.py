@@ -0,0 +1,169 @@
+import gzip
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import unicodedata
+from datetime import date, timedelta
+
+from preferences import paths
+
+
+EXPORT_URL = "http://files.tmdb.org/p/exports/{name}_ids_{date:%m_%d_%Y}.json.gz"
+
+# kind -> (export file name, title field, search endpoint)
+EXPORTS = {
+    'movie': ("movie", "original_title", "/search/movie"),
+    'tv': ("tv_series", "original_name", "/search/tv"),
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS titles (
+    kind TEXT NOT NULL,
+    norm TEXT NOT NULL,
+    title TEXT NOT NULL,
+    year INTEGER,
+    id INTEGER NOT NULL,
+    popularity REAL NOT NULL,
+    PRIMARY KEY (kind, norm, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS titles_id ON titles (kind, id);
+'''
+
+
+def index_file():
+    return paths.app() / 'titles.sqlite'
+
+# Lowercase, strip accents and punctuation: "Amélie: The Movie!" -> "amelie the movie"
+def normalize_title(title):
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(char for char in title if not unicodedata.combining(char))
+    title = title.lower().replace("&", " and ")
+    return " ".join(re.findall(r"[a-z0-9]+", title))
+
+
+# The export for `day`, or for yesterday: TMDB publishes each day's files the following morning
+def export_url(kind, day=None):
+    day = day or date.today() - timedelta(days=1)
+    return EXPORT_URL.format(name=EXPORTS[kind][0], date=day)
+
+
+def download(url, directory):
+    import requests
+
+    response = requests.get(url, stream=True, timeout=60)
+    response.raise_for_status()
+
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".json.gz", delete=False) as file:
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            file.write(chunk)
+
+    return file.name
+
+# Yield (norm, title, id, popularity) from a gzipped export, one JSON object per line
+def read_export(kind, file_path):
+    title_field = EXPORTS[kind][1]
+
+    with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            entry = json.loads(line)
+            if entry.get("adult") or entry.get("video"):
+                continue
+
+            title = entry.get(title_field) or ""
+            norm = normalize_title(title)
+            if norm:
+                yield norm, title, entry["id"], entry.get("popularity", 0)
+
+
+'''Local index of every TMDB title, built from the daily ID exports'''
+# Answers searches without the API. The exports only carry original titles, ids and popularity;
+# release years are filled in as real API searches come back through learn().
+class TitleIndex:
+    def __init__(self, path=None):
+        self.path = path or index_file()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    # Candidates for a title, most popular first: [(id, title, year, popularity)]
+    def find(self, kind, title, year=None, limit=10):
+        query = "SELECT id, title, year, popularity FROM titles WHERE kind = ? AND norm = ?"
+        values = [kind, normalize_title(title)]
+
+        # Titles with no known year still count, the year just can't rule them out
+        if year:
+            query += " AND (year IS NULL OR year = ?)"
+            values.append(int(year))
+
+        with self.lock:
+            return self.db.execute(query + " ORDER BY popularity DESC LIMIT ?", (*values, limit)).fetchall()
+
+    # Record release years from real API search results
+    def learn(self, kind, results):
+        date_field = "release_date" if kind == 'movie' else "first_air_date"
+        years = [(int(result[date_field][:4]), kind, result["id"])
+                 for result in results if (result.get(date_field) or "")[:4].isdigit()]
+
+        with self.lock:
+            self.db.executemany("UPDATE titles SET year = ? WHERE kind = ? AND id = ?", years)
+
+    def stats(self):
+        with self.lock:
+            rows = self.db.execute("SELECT kind, COUNT(*), COUNT(year) FROM titles GROUP BY kind").fetchall()
+
+        return {kind: {'titles': count, 'with_year': with_year} for kind, count, with_year in rows}
+
+    def close(self):
+        self.db.close()
+
+
+# Build a fresh index from the exports, keeping any years already learned.
+# `files` maps kind -> local export file; kinds without one are downloaded for `day`.
+# The new index is written alongside the old one and swapped in when complete.
+def build(files=None, day=None, path=None, logger=None):
+    path = path or index_file()
+    files = dict(files or {})
+    directory = os.path.dirname(path)
+    new_path = f"{path}.new"
+    downloaded = []
+
+    if os.path.exists(new_path):
+        os.unlink(new_path)
+
+    db = sqlite3.connect(new_path)
+    db.executescript(SCHEMA)
+
+    try:
+        for kind in EXPORTS:
+            if kind not in files:
+                url = export_url(kind, day)
+                if logger:
+                    logger.info("Downloading %s", url)
+                files[kind] = download(url, directory)
+                downloaded.append(files[kind])
+
+            rows = ((kind, norm, title, None, title_id, popularity) for norm, title, title_id, popularity in read_export(kind, files[kind]))
+            db.executemany("INSERT OR IGNORE INTO titles VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+        # Carry over release years learned from earlier API searches
+        if os.path.exists(path):
+            old = sqlite3.connect(path)
+            years = old.execute("SELECT year, kind, id FROM titles WHERE year IS NOT NULL").fetchall()
+            old.close()
+            db.executemany("UPDATE titles SET year = ? WHERE kind = ? AND id = ?", years)
+
+        db.commit()
+        db.execute("VACUUM")
+        db.close()
+    except BaseException:
+        db.close()
+        os.unlink(new_path)
+        raise
+    finally:
+        for file_path in downloaded:
+            os.unlink(file_path)
+
+    os.replace(new_path, path)
@@ -0,0 +1,353 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import parse_qsl
+
+
+from core import metrics, ratelimit
+from core.cache import make_key
+from core import ranking
+from core.ranking import ResolvedTitles
+
+
+# PYBUTLER_TMDB_URL points pyButler at another server, e.g. the stand-in in benchmarks/tmdb_stub.py
+BASE_URL = os.environ.get("PYBUTLER_TMDB_URL", "https://api.themoviedb.org/3")
+TIMEOUT = 10
+
+# Search endpoints the local title index can answer
+SEARCHES = {"/search/movie": "movie", "/search/tv": "tv"}
+
+
+# A request TMDB didn't answer, even after retrying, or answered with an error
+class TMDBError(Exception):
+    pass
+
+
+# TMDB's own explanation of an error response, if it gave one
+def error_message(response):
+    try:
+        return response.json()['status_message']
+    except (ValueError, KeyError, TypeError):
+        return response.reason
+
+
+'''One TMDB client for the whole run'''
+# Created once in main() and handed to every plugin, so all lookups share one cache
+# and one pool of keep-alive connections instead of opening new ones per file.
+class Client:
+    def __init__(self, api_key=None, base_url=BASE_URL, timeout=TIMEOUT, pool_size=10, cache=None, titles=None,
+                 rate_limit=ratelimit.RATE_LIMIT, retries=ratelimit.RETRIES):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        # Shared by every worker, so together they stay under TMDB's rate limit
+        self.bucket = ratelimit.TokenBucket(rate_limit)
+        # Requests on their way, by cache key. Workers asking the same thing wait for the one request.
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        # core.cache.MetadataCache, or None to always ask TMDB
+        self.cache = cache
+        # core.titles.TitleIndex to answer searches locally, or None
+        self.titles = titles
+        # The result each search so far resolved to, to answer repeats of it
+        self.resolved = ResolvedTitles()
+        self.pool_size = pool_size
+        self._session = None
+        self.session_lock = threading.Lock()
+
+    # Opened on the first request, so runs answered from the cache never import requests
+    @property
+    def session(self):
+        with self.session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self._session = requests.Session()
+
+                # Keep enough connections alive for every worker thread
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+
+        return self._session
+
+    # Fill the resolved titles with the searches already in the cache. The parameters are read back
+    # from the cache key.
+    def load_resolved(self):
+        for path, kind in SEARCHES.items():
+            for key, body in self.cache.entries(path):
+                self.learn_resolved(kind, dict(parse_qsl(key.partition("?")[2])), body.get("results", []))
+
+    # Remember the result a search resolves to, the one the plugins pick. The other results are
+    # left out, or they could answer later searches for titles they merely resemble.
+    def learn_resolved(self, kind, params, results):
+        year = params.get('year') or params.get('first_air_date_year')
+        result = ranking.best(results, params.get('query', ''), year)
+        if result is not None:
+            self.resolved.add(kind, params.get('query', ''), year, result)
+
+    def url(self, path):
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    # Drop unset parameters so optional filters (like year) can be passed straight through
+    def params(self, params, api_key=None):
+        params = {name: value for name, value in params.items() if value not in (None, "")}
+        params['api_key'] = api_key or self.api_key
+        return params
+
+    # GET an endpoint and return the decoded JSON body. Call from cache first.
+    # Raises TMDBError when TMDB can't be reached or answers with an error.
+    def get(self, path, **params):
+        params = self.params(params)
+        key = make_key(path, params)
+
+        if self.cache is not None:
+            body = self.cache.get(key)
+            if body is not None:
+                metrics.count("cache_hits")
+                return body
+            metrics.count("cache_misses")
+
+        if path in SEARCHES:
+            body = self.search_resolved(SEARCHES[path], params)
+            if body is not None:
+                metrics.count("resolved_hits")
+            elif self.titles is not None:
+                body = self.search_offline(SEARCHES[path], params)
+                if body is not None:
+                    metrics.count("offline_hits")
+            if body is not None:
+                return body
+
+        return self.coalesce(key, lambda: self.fetch(path, params, key))
+
+    # Run fetch() for the first caller of a key, later callers share its result (or its error)
+    def coalesce(self, key, fetch):
+        with self.inflight_lock:
+            pending = self.inflight.get(key)
+            first = pending is None
+            if first:
+                pending = self.inflight[key] = Future()
+
+        if not first:
+            metrics.count("coalesced")
+            return pending.result()
+
+        try:
+            pending.set_result(fetch())
+        except Exception as e:
+            pending.set_exception(e)
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+
+        return pending.result()
+
+    # Ask TMDB, then cache and learn from the answer
+    def fetch(self, path, params, key):
+        response = self.request(path, params)
+
+        if response.status_code not in (200, 404):
+            raise TMDBError(f"TMDB answered {response.status_code} for {path}: {error_message(response)}")
+
+        try:
+            body = response.json()
+        except ValueError:
+            raise TMDBError(f"TMDB sent an unreadable answer for {path}") from None
+
+        # Only cache real answers. A 404 or an empty result list is cached as a negative answer.
+        if self.cache is not None and response.status_code in (200, 404):
+            negative = response.status_code == 404 or body.get("results") == []
+            self.cache.put(path, key, body, negative=negative)
+
+        if path in SEARCHES and body.get("results"):
+            self.learn_resolved(SEARCHES[path], params, body["results"])
+
+            # Teach the local index the release years it doesn't get from the exports
+            if self.titles is not None:
+                self.titles.learn(SEARCHES[path], body["results"])
+
+        return body
+
+    # Answer a search with the result an earlier search for the same title resolved to
+    def search_resolved(self, kind, params):
+        year = params.get('year') or params.get('first_air_date_year')
+        result = self.resolved.match(kind, params['query'], year)
+        return {"results": [result], "total_results": 1} if result is not None else None
+
+    # Answer a search from the local title index, in the same shape as the API's results.
+    # Returns None when nothing matches, so the search goes to the API instead. The exports only
+    # have original titles, so a title answered here is named in its original language (e.g.
+    # "La casa de papel"), where an API search would give the English one ("Money Heist").
+    def search_offline(self, kind, params):
+        year = params.get('year') or params.get('first_air_date_year')
+        candidates = self.titles.find(kind, params['query'], year, limit=3)
+        results = []
+
+        for position, (title_id, title, known_year, popularity) in enumerate(candidates):
+            if kind == 'movie':
+                # Movie file names always carry a year, it's how they're recognised
+                release_year = known_year or year
+                results.append({"id": title_id, "title": title, "release_date": f"{release_year}-01-01", "popularity": popularity})
+                continue
+
+            first_air_year = known_year or year
+            if not first_air_year:
+                # Show folders need the first air year. Candidates come most popular first, which is
+                # the one ranking picks between equal titles, so only its details are fetched (and
+                # cached, and its year learned); the others are left out.
+                if position:
+                    continue
+                details = self.get(f"/tv/{title_id}")
+                first_air_year = (details.get("first_air_date") or "")[:4]
+                self.titles.learn(kind, [details])
+
+            first_air_date = f"{first_air_year}-01-01" if first_air_year else ""
+            results.append({"id": title_id, "name": title, "first_air_date": first_air_date, "popularity": popularity})
+
+        return {"results": results, "total_results": len(results)} if results else None
+
+    # Send a request within the rate limit, retrying when TMDB is throttling, failing or unreachable.
+    # Returns the final response, raises TMDBError once the retries run out.
+    def request(self, path, params):
+        import requests
+
+        for attempt in range(self.retries + 1):
+            time.sleep(self.bucket.reserve())
+            server_delay = None
+
+            try:
+                with metrics.timer("tmdb"):
+                    response = self.session.get(self.url(path), params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                problem = str(e)
+            else:
+                if response.status_code not in ratelimit.RETRY_STATUSES:
+                    return response
+
+                problem = f"{response.status_code} {error_message(response)}"
+                server_delay = ratelimit.retry_after(response.headers.get("Retry-After"))
+
+                # Throttling applies to the whole client, every worker backs off
+                if response.status_code == 429:
+                    metrics.count("tmdb_throttled")
+                    self.bucket.pause(ratelimit.backoff(attempt, server_delay))
+
+            if attempt < self.retries:
+                metrics.count("tmdb_retries")
+                time.sleep(ratelimit.backoff(attempt, server_delay))
+
+        raise TMDBError(f"TMDB request for {path} failed after {self.retries + 1} attempts: {problem}")
+
+    # An example request from tmdb. Never cached, the answer depends on the key.
+    def check_key(self, key):
+        return self.request("/movie/550", self.params({}, api_key=key))
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+'''asyncio flavour of Client'''
+# Optional, needs aiohttp installed. Use as `async with AsyncClient(key) as client:`
+# and gather as many lookups as needed; they share one connection pool of `pool_size`.
+class AsyncClient:
+    def __init__(self, api_key, base_url=BASE_URL, timeout=TIMEOUT, pool_size=10, cache=None,
+                 rate_limit=ratelimit.RATE_LIMIT, retries=ratelimit.RETRIES):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.cache = cache
+        self.retries = retries
+        self.bucket = ratelimit.TokenBucket(rate_limit)
+        # Requests on their way, by cache key, as tasks every caller can await
+        self.inflight = {}
+        self.session = None
+
+    async def __aenter__(self):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("AsyncClient requires aiohttp. Install it with 'pip install aiohttp'") from None
+
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    url = Client.url
+    params = Client.params
+
+    async def get(self, path, **params):
+        import asyncio
+
+        params = self.params(params)
+        key = make_key(path, params)
+
+        if self.cache is not None:
+            body = self.cache.get(key)
+            if body is not None:
+                metrics.count("cache_hits")
+                return body
+            metrics.count("cache_misses")
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self.fetch(path, params, key))
+            task.add_done_callback(lambda done: self.inflight.pop(key, None))
+        else:
+            metrics.count("coalesced")
+
+        return await task
+
+    async def fetch(self, path, params, key):
+        import asyncio
+        import aiohttp
+
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(self.bucket.reserve())
+            server_delay = None
+
+            try:
+                with metrics.timer("tmdb"):
+                    async with self.session.get(self.url(path), params=params) as response:
+                        status = response.status
+                        server_delay = ratelimit.retry_after(response.headers.get("Retry-After"))
+                        body = await response.json(content_type=None) if status not in ratelimit.RETRY_STATUSES else None
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                problem = str(e) or type(e).__name__
+            else:
+                if status not in ratelimit.RETRY_STATUSES:
+                    break
+
+                problem = str(status)
+                if status == 429:
+                    metrics.count("tmdb_throttled")
+                    self.bucket.pause(ratelimit.backoff(attempt, server_delay))
+
+            if attempt < self.retries:
+                metrics.count("tmdb_retries")
+                await asyncio.sleep(ratelimit.backoff(attempt, server_delay))
+        else:
+            raise TMDBError(f"TMDB request for {path} failed after {self.retries + 1} attempts: {problem}")
+
+        if status not in (200, 404):
+            raise TMDBError(f"TMDB answered {status} for {path}: {(body or {}).get('status_message')}")
+
+        if self.cache is not None:
+            negative = status == 404 or body.get("results") == []
+            self.cache.put(path, key, body, negative=negative)
+
+        return body
+
+    # Fetch several (path, params) pairs at once, results come back in the same order
+    async def get_many(self, requests):
+        import asyncio
+
+        return await asyncio.gather(*(self.get(path, **params) for path, params in requests))
@@ -0,0 +1,239 @@
+import errno
+import hashlib
+import os
+import shutil
+import time
+from collections import namedtuple
+
+
+MODES = ("move", "hardlink", "reflink", "copy")
+
+CHUNK_SIZE = 64 * 1024 * 1024 # per kernel copy call
+BUFFER_SIZE = 8 * 1024 * 1024 # for the plain read/write fallback and checksums
+PART_SUFFIX = ".pybutler-part"
+
+# ioctl(2) request to clone a file's extents (Btrfs, XFS, ...), from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors that just mean "this shortcut isn't possible here", rather than a real failure
+UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF}
+
+# method: how the data got there (rename, hardlink, reflink, copy_file_range, sendfile, copy)
+Result = namedtuple("Result", "method size seconds")
+
+
+'''Put a file at its destination'''
+#   move:     rename on the same filesystem, otherwise copy then delete the source
+#   hardlink: link the destination to the source, so seeding downloads aren't duplicated
+#   reflink:  copy-on-write clone, the same saving on filesystems that support it
+#   copy:     leave the source alone
+# hardlink and reflink fall back to a copy when the filesystem can't do them.
+# Copies go to a temporary file next to the destination, are checked (and checksummed when
+# verify is set) and only then renamed into place, so a failure never leaves a half-written file.
+# A file already at the destination is never replaced, FileExistsError is raised instead.
+def transfer(src, dst, mode="move", verify=False):
+    start = time.monotonic()
+    size = os.stat(src).st_size
+    method = None
+
+    if mode == "move" and same_device(src, dst):
+        try:
+            place(src, dst)
+            method = "rename"
+        except OSError as e:
+            # Two mounts of one filesystem (bind mounts, container volumes) share st_dev, but
+            # nothing can be renamed or linked across them. Copied instead.
+            if e.errno != errno.EXDEV:
+                raise
+
+    elif mode == "hardlink":
+        method = "hardlink" if attempt(os.link, src, dst) else None
+
+    elif mode == "reflink":
+        method = "reflink" if attempt(reflink, src, dst) else None
+
+    if method is None:
+        method = copy(src, dst, size, verify)
+
+        if mode == "move":
+            os.unlink(src)
+
+    return Result(method, size, time.monotonic() - start)
+
+
+# How many bytes transfer() will write to the destination device
+def space_needed(src, dst, size, mode="move"):
+    if mode == "copy":
+        return size
+
+    # A rename, link or clone on the same device writes no file data
+    if os.stat(src).st_dev == os.stat(existing_parent(os.path.dirname(dst))).st_dev:
+        return 0
+
+    return size
+
+# Walk up to the nearest directory that exists, destination folders may not be created yet
+def existing_parent(path):
+    path = path or "."
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def same_device(src, dst):
+    return os.stat(src).st_dev == os.stat(os.path.dirname(dst) or ".").st_dev
+
+# Try a shortcut, returning False instead of raising if the filesystem doesn't support it
+def attempt(func, src, dst):
+    try:
+        func(src, dst)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+        return False
+
+    return True
+
+
+# Rename src to dst, unless something is already there. rename() would replace it, a link fails
+# instead, even when another host is placing a file under the same name at the same moment.
+# Filesystems without hard links get a check before the rename.
+def place(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst) from None
+        os.rename(src, dst)
+    else:
+        os.unlink(src)
+
+
+def reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform") from None
+
+    part = dst + PART_SUFFIX
+    try:
+        with open(src, 'rb') as source, open(part, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        shutil.copystat(src, part)
+        place(part, dst)
+    except BaseException:
+        remove(part)
+        raise
+
+
+def copy(src, dst, size, verify=False):
+    part = dst + PART_SUFFIX
+    try:
+        with open(src, 'rb') as source, open(part, 'wb') as target:
+            method = copy_data(source, target, size)
+            target.flush()
+            os.fsync(target.fileno())
+
+            if os.fstat(target.fileno()).st_size != size:
+                raise OSError(errno.EIO, f"Copy of {src} is incomplete")
+
+        shutil.copystat(src, part)
+
+        if verify and checksum(src) != checksum(part):
+            raise OSError(errno.EIO, f"Checksum mismatch after copying {src}")
+
+        place(part, dst)
+    except BaseException:
+        remove(part)
+        raise
+
+    return method
+
+# Copy inside the kernel where possible: copy_file_range, then sendfile, then plain reads and writes.
+# Which errors mean "not here" varies by platform (sendfile to a file is ENOTSOCK on macOS), so any
+# error before a method writes its first byte moves on to the next one. A real problem, like a full
+# disk, fails again in the plain copy. Some filesystems (FUSE, NFS, overlays) stop returning data
+# before the end instead, so a method that falls short of `size` also hands over to the next one,
+# carrying on from where it got to.
+def copy_data(source, target, size):
+    for method, kernel_copy in (("copy_file_range", copy_range), ("sendfile", send_file)):
+        start = target.tell()
+        try:
+            kernel_copy(source.fileno(), target.fileno())
+        except AttributeError:
+            # Not available on this platform
+            continue
+        except OSError:
+            if target.tell() > start:
+                raise
+
+        done = target.tell()
+        if done >= size:
+            return method
+        source.seek(done)
+
+    shutil.copyfileobj(source, target, BUFFER_SIZE)
+    return "copy"
+
+
+def copy_range(src_fd, dst_fd):
+    while os.copy_file_range(src_fd, dst_fd, CHUNK_SIZE) > 0:
+        pass
+
+
+# From the current offset, which the source's offset is kept in step with
+def send_file(src_fd, dst_fd):
+    offset = os.lseek(dst_fd, 0, os.SEEK_CUR)
+    while True:
+        sent = os.sendfile(dst_fd, src_fd, offset, CHUNK_SIZE)
+        if sent == 0:
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            return
+        offset += sent
+
+
+def checksum(file_path):
+    digest = hashlib.blake2b()
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    with open(file_path, 'rb') as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                return digest.hexdigest()
+            digest.update(view[:read])
+
+
+def remove(file_path):
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+
+# Remove `directory` and its parents below `root` for as long as they're empty, e.g. the release
+# folder a file was moved out of. Anything left in a folder (a sample, subtitles) keeps it.
+def prune(directory, root):
+    root = os.path.join(os.path.abspath(root), "")
+    directory = os.path.abspath(directory)
+
+    while directory.startswith(root):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
@@ -0,0 +1,252 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from core import scanner
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct("iIII") # wd, mask, cookie, len
+
+
+'''inotify watch on a directory and its sub-directories, down to `depth` levels'''
+# Reports files that were closed after writing or moved in, and directories that appeared.
+# Raises OSError when inotify isn't available (not Linux, out of watches, ...).
+class Inotify:
+    def __init__(self, directory, depth=0):
+        library = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform")
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.directory = directory
+        self.depth = depth
+        # watch descriptor -> (path relative to `directory`, level below it)
+        self.watches = {}
+        self.overflowed = False
+
+        try:
+            self.add_watch("", 0)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    # Watch a directory, plus any sub-directories it already has that are within depth
+    def add_watch(self, relative_dir, level):
+        path = os.path.join(self.directory, relative_dir)
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Unable to watch {path}")
+
+        self.watches[wd] = (relative_dir, level)
+
+        if self.depth is not None and level >= self.depth:
+            return
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'):
+                    self.add_watch(os.path.join(relative_dir, entry.name), level + 1)
+
+    # Wait up to `timeout` seconds (None = forever).
+    # Returns (relative path, is_dir) for every file or directory that changed.
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        changes = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            if wd not in self.watches or not name:
+                continue
+
+            relative_dir, level = self.watches[wd]
+            relative_path = os.path.join(relative_dir, name)
+
+            if not mask & IN_ISDIR:
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    changes.append((relative_path, False))
+
+            elif self.depth is None or level < self.depth:
+                try:
+                    self.add_watch(relative_path, level + 1)
+                except OSError:
+                    continue
+                changes.append((relative_path, True))
+
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+'''Polling fallback for Inotify'''
+# Rescans the directory every `interval` seconds and reports new or changed files.
+class Poller:
+    def __init__(self, directory, interval, extensions, depth=0, include=(), exclude=()):
+        self.directory = directory
+        self.interval = interval
+        self.scan_args = (extensions, depth, include, exclude)
+        self.overflowed = False
+        # Files present when watching starts are left to the initial run
+        self.known = self.snapshot()
+
+    def snapshot(self):
+        snapshot = {}
+
+        for entry in scanner.scan(self.directory, *self.scan_args):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Moved away since the scan listed it, e.g. by a transfer
+                continue
+            snapshot[os.path.relpath(entry.path, self.directory)] = (stat.st_size, stat.st_mtime_ns)
+
+        return snapshot
+
+    def read(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+
+        current = self.snapshot()
+        changed = [(name, False) for name, stat in current.items() if self.known.get(name) != stat]
+        self.known = current
+        return changed
+
+    def close(self):
+        pass
+
+
+'''Watch a source directory and hand over files once they have finished being written'''
+# A file is handed over once its size and mtime have stayed the same for `settle` seconds,
+# so downloads that are still being written (or reopened by the client) are left alone.
+# depth, include and exclude work the same as for scanner.scan().
+class Watcher:
+    def __init__(self, directory, extensions, settle=5, interval=10, logger=None, depth=0, include=(), exclude=()):
+        self.directory = directory
+        self.extensions = extensions
+        self.settle = settle
+        self.logger = logger
+        self.depth = depth
+        self.include = include
+        self.exclude = exclude
+        # relative path -> (size, mtime_ns, time first seen with that size and mtime)
+        self.pending = {}
+
+        try:
+            self.source = Inotify(directory, depth)
+            self.backend = "inotify"
+        except OSError as e:
+            if logger:
+                logger.info("inotify unavailable (%s), polling every %ss instead", e, interval)
+            self.source = Poller(directory, interval, extensions, depth, include, exclude)
+            self.backend = "polling"
+
+    # Yield lists of file paths that are ready to be processed. Runs until interrupted.
+    def __iter__(self):
+        try:
+            while True:
+                # Sleep until something happens, or until pending files are due a re-check
+                timeout = self.settle if self.pending else None
+                for relative_path, is_dir in self.source.read(timeout):
+                    if is_dir:
+                        self.add_directory(relative_path)
+                    elif scanner.wanted(relative_path, self.extensions, self.include, self.exclude):
+                        self.pending.setdefault(relative_path, None)
+
+                if self.source.overflowed:
+                    self.source.overflowed = False
+                    self.rescan()
+
+                ready = self.settled()
+                if ready:
+                    yield ready
+        finally:
+            self.source.close()
+
+    # A directory appeared (e.g. a finished release folder was moved in), pick up what's inside
+    def add_directory(self, relative_dir):
+        if scanner.excluded(relative_dir, self.exclude):
+            return
+
+        level = relative_dir.count(os.sep) + 1
+        depth = None if self.depth is None else self.depth - level
+        for entry in scanner.scan(os.path.join(self.directory, relative_dir), self.extensions, depth, self.include, self.exclude):
+            self.pending.setdefault(os.path.relpath(entry.path, self.directory), None)
+
+    # Events were dropped, fall back to looking at everything in the directory
+    def rescan(self):
+        if self.logger:
+            self.logger.warning("Too many changes at once, rescanning %s", self.directory)
+
+        for entry in scanner.scan(self.directory, self.extensions, self.depth, self.include, self.exclude):
+            self.pending.setdefault(os.path.relpath(entry.path, self.directory), None)
+
+    # Files found by the scan run when watching starts get the same check. Those whose mtime is
+    # already `settle` seconds old haven't changed for that long and are returned straight away; the
+    # rest are left pending, to come out of the watcher once they settle. Takes and returns
+    # (file_path, stat) pairs.
+    def settled_files(self, files):
+        now = time.time()
+        ready = []
+
+        for file_path, stat in files:
+            if now - stat.st_mtime >= self.settle:
+                ready.append((file_path, stat))
+            else:
+                name = os.path.relpath(file_path, self.directory)
+                self.pending[name] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+
+        return ready
+
+    # Return files whose size and mtime haven't changed for `settle` seconds
+    def settled(self):
+        now = time.monotonic()
+        ready = []
+
+        for name, seen in list(self.pending.items()):
+            file_path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+
+            if seen is None or seen[:2] != (stat.st_size, stat.st_mtime_ns):
+                self.pending[name] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - seen[2] >= self.settle:
+                del self.pending[name]
+                ready.append(file_path)
+
+        return sorted(ready)
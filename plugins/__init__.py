@@ -0,0 +1,93 @@
+import importlib
+import os
+
+from core import metrics, parser
+
+
+# What a plugin's lookups spend their time waiting on, so they can run on the right pool
+NETWORK = "network"
+IO = "io"
+
+# Video containers, probed for their resolution and codec
+VIDEO = ('.mkv', '.mp4')
+
+
+'''A plugin, described without importing it'''
+# name is the module in plugins/ and the library in config.json its files go to. classify is a
+# cheap test on the parsed file name, for extensions shared with other plugins; a plugin without
+# one takes whatever the plugins before it turned down. The module is only imported once a file
+# of its kind turns up, and has to provide resolve(file_path, client, library, parsed, quality).
+class Plugin:
+    def __init__(self, name, extensions, bound, classify=None):
+        self.name = name
+        self.extensions = extensions
+        self.bound = bound
+        self.classify = classify
+        self.loaded = None
+
+    @property
+    def module(self):
+        if self.loaded is None:
+            self.loaded = importlib.import_module(f"{__name__}.{self.name}")
+        return self.loaded
+
+    # Where the file belongs in `library`, or None if it can't be placed
+    def resolve(self, file_path, client, library, parsed=None, quality=None):
+        return self.module.resolve(file_path, client, library, parsed, quality)
+
+
+def is_episode(parsed):
+    return parsed.kind == "episode"
+
+
+# Tried in this order for each extension
+registry = (
+    Plugin("show", VIDEO, NETWORK, classify=is_episode),
+    Plugin("movie", VIDEO, NETWORK),
+    Plugin("audiobook", ('.m4b',), IO),
+)
+
+# extension -> the plugins for it, in registry order
+by_extension = {}
+for plugin in registry:
+    for extension in plugin.extensions:
+        by_extension.setdefault(extension, []).append(plugin)
+
+# Every extension some plugin handles, the only files scanned for
+EXTENSIONS = tuple(by_extension)
+
+
+def get(name):
+    return next(plugin for plugin in registry if plugin.name == name)
+
+
+# The plugin for a file and its parsed name: (None, ...) if no plugin takes it. The name is only
+# parsed when a classifier needs it, otherwise parsed is None.
+def classify(file_path):
+    parsed = None
+
+    for plugin in by_extension.get(os.path.splitext(file_path)[1], ()):
+        if plugin.classify is None:
+            return plugin, parsed
+
+        if parsed is None:
+            with metrics.timer("parse"):
+                parsed = parser.parse(os.path.basename(file_path))
+
+        if plugin.classify(parsed):
+            return plugin, parsed
+
+    return None, parsed
+
+
+# Let loaded plugins drop what they remember from earlier lookups, for a long-running --watch
+def forget():
+    for plugin in registry:
+        if plugin.loaded is not None and hasattr(plugin.loaded, "forget"):
+            plugin.loaded.forget()
+
+
+# What looking a file up waits on, from its extension alone. None for files no plugin handles.
+def bound(file_path):
+    plugins = by_extension.get(os.path.splitext(file_path)[1])
+    return plugins[0].bound if plugins else None
@@ -1,7 +1,7 @@
 import os
 import re
 
-from mutagen.mp4 import MP4
+from core import metrics, tags
 from preferences import logging
 
 
@@ -17,31 +17,43 @@ def remove_illegal_chars(tag_title):
 	clean_title = re.sub(r'[<>:"/\\|?*]', '_', tag_title)
 	return clean_title
 
-# Organise m4b files into dir structure: ...target/Author/Audiobookname.m4b
+# Organise audiobooks into dir structure: ...target/Author/Audiobookname.ext
+# Tags are only read here. Any that need changing are left in core/tags.py and written once the
+# file has been moved, so the source is never rewritten and each audiobook is written at most once.
 def process(file_path, book_path):
 	file = os.path.basename(file_path)
+	stem, extension = os.path.splitext(file)
 
 	try:
-		audio = MP4(file_path)
-		author = audio.get('\xa9ART', ["Unknown Author"])[0]
-		title = audio.get('\xa9nam', file)[0]
-
-		tag_title = remove_unabridged(title)
-		clean_title = remove_illegal_chars(tag_title)
-
-		audio['\xa9alb'] = tag_title # album tag
-		audio['\xa9nam'] = tag_title # title tag
-		audio.save()
-
-	except: # Should be MP4somethingERROR, but would require a broader import from mutagen
-		logger.error("Not a .mp4 file. Please check this is a real!")
-
+		with metrics.timer("tagging"):
+			# The reader for the file's format, so any extension the registry sends here works
+			audio = tags.read(file_path)
+			author = audio.get('artist', ["Unknown Author"])[0]
+			title = audio.get('title', [stem])[0]
+
+			tag_title = remove_unabridged(title)
+			clean_title = remove_illegal_chars(tag_title)
+
+			# album and title tags
+			changes = {tag: tag_title for tag in ('album', 'title') if audio.get(tag) != [tag_title]}
+			if changes:
+				tags.pending[file_path] = changes
+			else:
+				metrics.count("tags_unchanged")
+
+	except: # Should be a MutagenError, but would require a broader import from mutagen
+		logger.error("Unable to read the tags of this file. Please check this is a real audiobook!")
+
+	# Created when the file is moved
 	author_folder = os.path.join(book_path, author)
 
-	if not os.path.exists(author_folder):
-		os.makedirs(author_folder)
+	return os.path.join(author_folder, f"{clean_title}{extension}")
+
 
-	return os.path.join(author_folder, f"{clean_title}.m4b")
+# Entry point for the plugin registry (plugins/__init__.py), library is the audiobook folder.
+# Audiobooks are named from their tags, there's nothing to look up or parse.
+def resolve(file_path, client, library, parsed=None, quality=None):
+	return process(file_path, book_path=library)
 
 
 if __name__ == '__main__':
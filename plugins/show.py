@@ -1,134 +1,148 @@
-import json
 import os
-import re
-from datetime import timedelta
+import threading
 
-import requests_cache
+from core import parser, ranking
 from preferences import logging
 
 
 logger = logging.setup()
 
+# In-run lookup tables, shared by every file (and worker) in the run.
+# shows: (show_name, show_year) -> (show_id, show_name, show_year), or None when TMDB has no match
+# seasons: (show_id, season) -> {episode: episode_title}
+shows = {}
+seasons = {}
+
+# One lock per lookup, so workers wanting the same show or season wait for a single request
+lookup_locks = {}
+lookup_locks_guard = threading.Lock()
+
+# Empty the lookup tables, so shows and seasons are looked up again (through the cache, which
+# expires them). Between batches only, never while lookups are running.
+def forget():
+    with lookup_locks_guard:
+        shows.clear()
+        seasons.clear()
+        lookup_locks.clear()
+
 '''Process a TV Show File'''
 #   This can be called from another script with the args.
-def process(file_path, api_key, show_path):
+#   parsed is the parser.ParsedName of the file name, parsed here when not given.
+#   quality is added to the name when given, e.g. "1080p HEVC".
+def process(file_path, client, show_path, parsed=None, quality=None):
     file_name = os.path.basename(file_path)
     ext = get_file_extension(file_name)
+    parsed = parsed or parser.parse(file_name)
 
     # Search info with TMDB and return vars needed for renaming file.
     try:
-        show_name, show_year, season_num, episode_num, episode_title = get_show_info(file_name, api_key)
+        show_name, show_year, season_num, episode_num, episode_title = get_show_info(parsed, client)
     except TypeError:
         logger.error("Show information returned no results. Please check the title and year is correct.")
     else:
-        # Create dirs and rename file
-        season_dir = create_show_dirs(show_name, show_year, season_num, show_path)
-        new_file_name = rename_show_file(show_name, season_num, episode_num, episode_title, ext)
+        # Work out the dirs and rename file. The dirs are created when the file is moved.
+        season_dir = get_season_dir(show_name, show_year, season_num, show_path)
+        new_file_name = rename_show_file(show_name, season_num, episode_num, episode_title, ext, quality)
 
         # move the file to new location
         new_path = os.path.join(season_dir, new_file_name)
         return new_path
     
 
+# Entry point for the plugin registry (plugins/__init__.py), library is the show folder
+def resolve(file_path, client, library, parsed=None, quality=None):
+    return process(file_path, client, show_path=library, parsed=parsed, quality=quality)
+
+
 def get_file_extension(file_name):
     splitext = os.path.splitext(file_name)
     file_extension = splitext[1]
     return file_extension
 
 
-def check_for_year(file_name):
-    show_name = ""
-    # Most don't have the year, so likely will return None
-    show_search = re.search("(?i)(.*)((\W)([0-9]{4})(\W*))(?=S\d+)", file_name)
-    
-    if show_search is not None:
-        show_name = (show_search.group(1)).strip()
-        show_year = (show_search.group(4))
-    else:
-        show_name = get_show_name(file_name)
-        show_year = ""
-
-    return clean_show_name(show_name), show_year
+# Replace colon with adash
+def remove_colon(source_info):
+    source_info = source_info.replace(": ", " - ")
+    return source_info
 
+# Show name and year to search for. Most names don't have the year, so it's usually ""
+def show_key(parsed):
+    return remove_invalid_chars(parsed.title), str(parsed.year or "")
 
-def get_show_name(file_name):
-    show_name_search = re.search("(?i)(^.*)(S\d+E\d+)", file_name)
+# Query TMDB
+def get_show_info(parsed, client):
+    if parsed.kind != "episode" or not parsed.title:
+        logger.error("Unable to parse show title from file name.")
+        return None
 
-    if show_name_search is not None:
-        show_name = (show_name_search.group(1)).strip()
+    show_name, show_year = show_key(parsed)
+    show_info = find_show(show_name, show_year, client)
 
-    else:
-        logger.error("Unable to parse show title from file name.")
+    if show_info is not None:
+            show_id, show_name, show_year = show_info
 
-    return clean_show_name(show_name)
+            # Season and episode numbers, zero padded. Multi-episode files are named after every episode
+            season_num = f"{parsed.season:02d}"
+            episode_num = "-E".join(f"{episode:02d}" for episode in parsed.episodes)
 
+            # get episode titles
+            titles = [get_episode_title(show_id, parsed.season, episode, client) for episode in parsed.episodes]
+            episode_title = " & ".join(title for title in titles if title)
 
-def clean_show_name(show_name):
-    # Check for dots and replace
-    re_dots = re.search("\.", show_name)
-    if re_dots is not None:
-        show_name = show_name.replace(".", " ")
-        show_name = show_name.strip()
+            return show_name, show_year, season_num, episode_num, episode_title
 
-    # Cleanup - removes any extra dashes that seem to be included in previous replace)
-    re_dash = re.search("-", show_name)
-    if re_dash is not None:
-        show_name = show_name.replace("-", "")
-        show_name = show_name.strip()
 
-    show_name = remove_invalid_chars(show_name)
-    return show_name
+def lookup_lock(key):
+    with lookup_locks_guard:
+        return lookup_locks.setdefault(key, threading.Lock())
 
+# Search TMDB once per show name for the whole run
+def find_show(show_name, show_year, client):
+    key = (show_name.lower(), show_year)
 
-def get_season_num(file_name):
-    # Paste the season number
-    season_search = re.search("(?i)(S(\d+))(E(\d+))", file_name, re.IGNORECASE)
-    season_num = season_search.group(2)
-    return season_num
+    with lookup_lock(key):
+        if key not in shows:
+            # Use more accurate search if show year is present
+            search_results = client.get("/search/tv", query=show_name, include_adult="false", first_air_date_year=show_year).get("results", [])
 
+            # Return the result closest to the parsed title and year, parsed to get proper show info
+            info = ranking.best(search_results, show_name, show_year)
+            shows[key] = parse_show_info(info) if info is not None else None
 
-def get_episode_num(file_name):
-    # Parse the episode number
-    episode_search = re.search("(?i)(S(\d+))(E(\d+))", file_name, re.IGNORECASE)
-    episode_num = episode_search.group(4)
-    return episode_num
+    return shows[key]
 
-# Replace colon with adash
-def remove_colon(source_info):
-    source_info = source_info.replace(": ", " - ")
-    return source_info
+# Fetch a whole season once and keep a table of its episode titles
+def get_season(show_id, season_num, client):
+    key = (show_id, int(season_num))
 
-# Query TMDB
-def get_show_info(file_name, api_key):
-    
-    show_name, show_year = check_for_year(file_name)
+    with lookup_lock(key):
+        if key not in seasons:
+            season_info = client.get(f"/tv/{show_id}/season/{int(season_num)}", language="en-US")
+            episodes = season_info.get("episodes", [])
+            seasons[key] = {episode["episode_number"]: episode["name"] for episode in episodes}
 
-    # Use more accurate url if show year is present
-    if show_year:
-        search_url = f"https://api.themoviedb.org/3/search/tv?api_key={api_key}&query={show_name}&include_adult=false&first_air_date_year={show_year}"
-    
-    else:
-        search_url = f"https://api.themoviedb.org/3/search/tv?api_key={api_key}&query={show_name}&include_adult=false"
+    return seasons[key]
 
-    # Cache and fetch results. Call from cache first.
-    session = requests_cache.CachedSession("pybutler_show_query", use_temp=True, expire_after=timedelta(days=30))
-    search_results = json.loads(session.get(search_url).text)["results"]
+# Group parsed file names (parser.ParsedName) by show, collecting the seasons each show needs
+def group_files(parsed_names):
+    groups = {}
 
-    if len(search_results) > 0:
-            # Return top result
-            info = search_results[0]
+    for parsed in parsed_names:
+        if parsed.kind != "episode" or not parsed.title:
+            continue
 
-            # parse these results to get proper show info
-            show_id, show_name, show_year = parse_show_info(info)
+        groups.setdefault(show_key(parsed), set()).add(parsed.season)
 
-            # Get season and episode num
-            season_num = get_season_num(file_name)
-            episode_num = get_episode_num(file_name)
+    return groups
 
-            # get episode title
-            episode_title = get_episode_title(show_id, season_num, episode_num, api_key)
+# Search a show and fetch its seasons up front, so its episodes resolve from memory
+def prefetch(show, season_nums, client):
+    show_name, show_year = show
+    show_info = find_show(show_name, show_year, client)
 
-            return show_name, show_year, season_num, episode_num, episode_title
+    if show_info is not None:
+        for season_num in sorted(season_nums):
+            get_season(show_info[0], season_num, client)
 
 
 def parse_show_info(info):
@@ -148,47 +162,41 @@ def remove_invalid_chars(input):
     return output
 
 
-def get_episode_title(show_id, season_num, episode_num, api_key):
-    # get episode title
-    episode_url = f"https://api.themoviedb.org/3/tv/{show_id}/season/{season_num}/episode/{episode_num}?api_key={api_key}&language=en-US"
-
-    # Cache and fetch results. Call from cache first.
-    session = requests_cache.CachedSession("pybutler_episode_query", use_temp=True, expire_after=timedelta(days=30))
-    episode_info = json.loads(session.get(episode_url).text)
+def get_episode_title(show_id, season_num, episode_num, client):
+    # get episode title from the season table
+    episode_title = get_season(show_id, season_num, client).get(int(episode_num))
 
     # Episode Check
-    if not episode_info.get("success"):
+    if episode_title is None:
         logger.error("Show results were found but season or epiosde numbers may be wrong.")
         episode_title = ""
 
     else:
-        # Get episode title from result
-        episode_title = episode_info["name"]
-
         # Remove invalid chars
         episode_title = remove_invalid_chars(episode_title)
     
     return episode_title
 
 
-#   Create the show directories. 
+#   Path of the show's season directory.
 #   We do not need to return the show_dir itself as it's part of the season_dir path
-def create_show_dirs(show_name, show_year, season_num, show_path):
+def get_season_dir(show_name, show_year, season_num, show_path):
     show_dir_name = f"{show_name} ({show_year})"
     show_dir = os.path.join(show_path, show_dir_name)
 
     season_dir_name = f"Season {season_num}"
     season_dir = os.path.join(show_dir, season_dir_name)
 
-    if not os.path.exists(season_dir):
-        os.makedirs(season_dir, exist_ok=True)
-
     return season_dir
 
 
-def rename_show_file(show_name, season_num, episode_num, episode_title, ext):
+def rename_show_file(show_name, season_num, episode_num, episode_title, ext, quality=None):
     new_file_name = f"{show_name} - S{season_num}E{episode_num} - {episode_title}{ext}"
 
+    # Resolution and codec, e.g. "Cool TV Show - S01E01 - Episode Title [1080p HEVC].mkv"
+    if quality:
+        new_file_name = f"{show_name} - S{season_num}E{episode_num} - {episode_title} [{quality}]{ext}"
+
     return new_file_name
 
 
@@ -1,17 +1,41 @@
+import hashlib
 import json
 import os
+import time
 
-import requests
 import getpass
 from dotenv import load_dotenv, set_key
 
+from core import tmdb
 from preferences import paths, logging, style
 
 
+# Keys in config.json that must point at an existing directory. Anything else is an optional setting.
+DIRECTORIES = ('source', 'movie', 'show', 'audiobook')
+
+# How long a key that passed the check is trusted before it's checked with TMDB again
+KEY_CHECK_TTL = 7 * 24 * 60 * 60
+
+# Without anyone to answer a prompt (--batch), a problem only a person can fix ends the run instead
+def cannot_ask(logger, problem):
+    logger.error("%s, run pyButler without --batch to fix it", problem)
+    raise SystemExit(1)
+
+# Read config.json as-is, without validating or prompting. For commands that only need optional settings.
+def peek(config_file=paths.config_file()):
+    try:
+        with open(config_file, 'r') as file:
+            return json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
 class Config:
-    def __init__(self, config_file=paths.config_file(), logger=logging.setup()):
+    def __init__(self, config_file=paths.config_file(), logger=logging.setup(), interactive=True):
         # Pass logger
         self.logger = logger
+        # May the user be asked to fix the config?
+        self.interactive = interactive
         # Pass config.json path
         self.config_file = config_file
         # Load and verify configs
@@ -34,32 +58,47 @@ class Config:
             try:
                 with open(self.config_file, 'r') as file:
                     temp_configs = json.load(file)
+                    changed = False
                     for key, directory in temp_configs.items():
+                        if key not in DIRECTORIES:
+                            continue
+
                         # Check if directory exists on filesystem
                         while not os.path.isdir(directory):
                             e = f"{key} directory does not exist or is not valid: {directory}"
+                            if not self.interactive:
+                                cannot_ask(self.logger, e)
                             self.logger.error(e)
                             # Prompt user for new path to existing directory
-                            new_directory = input(f"Please enter a valid directory for {key}: ")
+                            new_directory = logging.ask(f"Please enter a valid directory for {key}: ")
                             temp_configs[key] = new_directory
                             directory = new_directory
+                            changed = True
                             self.logger.info(f"Updated {key} to: {new_directory}")
                     
-                    self.write(temp_configs)
+                    # Only rewrite the file when a directory was corrected
+                    if changed:
+                        self.write(temp_configs)
 
-                    print(style.green("Config check: OK!"))
+                    logging.echo(style.green("Config check: OK!"))
                     return True
 
             except json.JSONDecodeError:
                 e = "Unable to read the contents of the config file"
+                if not self.interactive:
+                    cannot_ask(self.logger, e)
                 self.logger.error(e)
                 return False
             except Exception as e:
                 e = f"Unexpected error: {e}"
+                if not self.interactive:
+                    cannot_ask(self.logger, e)
                 self.logger.error(e)
                 return False
         else:
             e = "No config file found"
+            if not self.interactive:
+                cannot_ask(self.logger, e)
             self.logger.error(e)
             self.create()
 
@@ -70,11 +109,11 @@ class Config:
 
     # Setup of directories required
     def create(self):
-        print("Let's setup a new config file...")
-        source_dir = input("Source folder: ")
-        movie_dir = input("Movie target folder: ")
-        show_dir = input("TV Show target folder: ")
-        audiobook_dir = input("Audiobook target folder: ")
+        logging.echo("Let's setup a new config file...")
+        source_dir = logging.ask("Source folder: ")
+        movie_dir = logging.ask("Movie target folder: ")
+        show_dir = logging.ask("TV Show target folder: ")
+        audiobook_dir = logging.ask("Audiobook target folder: ")
 
         new_configs = {
             "source": source_dir,
@@ -94,16 +133,25 @@ class Config:
             movie_msg = f"Movies \t→ {self.configs['movie']}"
             shows_msg = f"Shows \t→ {self.configs['show']}"
             books_msg = f"Books \t→ {self.configs['audiobook']}"
-            print(f"{config_msg}\n{source_msg}\n{movie_msg}\n{shows_msg}\n{books_msg}")
+            logging.echo(f"{config_msg}\n{source_msg}\n{movie_msg}\n{shows_msg}\n{books_msg}")
         else:
             e = "Configs not loaded or invalid"
             self.logger.error(e)
 
 
+# Identifies a key without storing it twice
+def key_fingerprint(key):
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
 class Auth:
-    def __init__(self, auth_file=paths.auth_file(), logger=logging.setup()):
+    def __init__(self, auth_file=paths.auth_file(), logger=logging.setup(), client=None, interactive=True):
         self.logger = logger
+        # May the user be asked for a key?
+        self.interactive = interactive
         self.auth_file = auth_file
+        # Validate through the shared TMDB client when one is given
+        self.client = client or tmdb.Client()
         self.key = self.load()
 
     # Load the .env and validate
@@ -120,33 +168,60 @@ class Auth:
                 load_dotenv(self.auth_file)
 
                 if 'tmdb_api_key' in os.environ:
-                    # An example request from tmdb
                     key = os.environ.get('tmdb_api_key')
-                    test_url = f"https://api.themoviedb.org/3/movie/550?api_key={key}"
 
-                    print(style.dark("Validating TMDB API key..."), end='\r')
-                    style.clear_line()
+                    # A key that passed recently is trusted without asking TMDB again
+                    if self.recently_checked(key):
+                        return True
+
+                    logging.echo(style.dark("Validating TMDB API key..."), end='\r')
+                    logging.echo(end=style.CLEAR_LINE)
                     
-                    response = requests.get(test_url)
+                    # An example request from tmdb
+                    try:
+                        response = self.client.check_key(key)
+                    except tmdb.TMDBError as e:
+                        self.logger.error(e)
+                        raise SystemExit(1)
                     # Request successful
                     if response.status_code == 200:
-                        print(style.green("TMDB API check: OK!"))
+                        logging.echo(style.green("TMDB API check: OK!"))
+                        self.remember(key)
                         return True
                     # Request failed
                     else:
                         status_message = response.json()['status_message']
+                        if not self.interactive:
+                            cannot_ask(self.logger, f"TMDB refused the API key: {status_message}")
                         self.logger.error(status_message)
                         self.input()
                 # .env exists but, there's no key/value for 'tmdb_api_key'
                 else:
+                    if not self.interactive:
+                        cannot_ask(self.logger, f"No TMDB API key in {self.auth_file}")
                     self.logger.warning("No TMDB API key found!")
                     self.input()
         # .env doesn't exist
         else:
+            if not self.interactive:
+                cannot_ask(self.logger, f"No TMDB API key found, {self.auth_file} doesn't exist")
             self.logger.warning("No TMDB API key found!")
             self.create()
 
 
+    # The last successful check is kept in .env as "<key fingerprint> <timestamp>"
+    def recently_checked(self, key):
+        try:
+            fingerprint, checked = os.environ.get('tmdb_key_checked', '').split()
+            return fingerprint == key_fingerprint(key) and time.time() - float(checked) < KEY_CHECK_TTL
+        except ValueError:
+            return False
+
+    def remember(self, key):
+        os.environ['tmdb_key_checked'] = f"{key_fingerprint(key)} {int(time.time())}"
+        set_key(self.auth_file, 'tmdb_key_checked', os.environ['tmdb_key_checked'])
+
+
     def create(self):
         with open(self.auth_file, 'w+'):
             self.input()
@@ -155,6 +230,7 @@ class Auth:
     # getpass protected user input for the api key
     def input(self):
         load_dotenv(self.auth_file)
+        logging.flush()
         os.environ['tmdb_api_key'] = getpass.getpass("Please input a valid TMDB API key: ")
         set_key(self.auth_file, 'tmdb_api_key', os.environ['tmdb_api_key'])
 
@@ -1,34 +1,164 @@
+import atexit
+import json
 import logging
 import coloredlogs
 import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from preferences import paths
 
+# Per-thread buffer used by capture() to hold back records until they can be replayed in order
+_held = threading.local()
+
+# Records waiting for the writer thread. Workers only ever put records here, the terminal and the
+# log files are written by the one writer thread, so a slow console never holds up a lookup or a move.
+log_queue = queue.Queue()
+listener = None
+
+
+class HoldFilter(logging.Filter):
+    def filter(self, record):
+        records = getattr(_held, 'records', None)
+        if records is None:
+            return True
+
+        records.append(record)
+        return False
+
+
+hold_filter = HoldFilter()
+
+
+def is_echo(record):
+    return getattr(record, 'echo', False)
+
+def is_log(record):
+    return not is_echo(record)
+
+
+'''Plain console lines'''
+# echo() lines travel through the queue with the log records, so everything comes out in the order
+# it happened, but they're printed as they are, to whatever sys.stdout is at the time.
+class EchoHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            sys.stdout.write(record.getMessage() + record.end)
+            sys.stdout.flush()
+        except Exception:
+            self.handleError(record)
+
+
+'''JSON log lines'''
+# One object per record, for log collectors
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname, "thread": record.threadName, "message": record.getMessage()}
+        return json.dumps(entry, ensure_ascii=False)
+
+
+'''Writer thread'''
+# A progress display sets pause to a context manager that takes it off the screen while lines are written
+class Writer(QueueListener):
+    pause = None
+
+    def handle(self, record):
+        if self.pause is None:
+            return super().handle(record)
+
+        with self.pause():
+            super().handle(record)
+
+
 def setup():
-    # Check if the logging has already been configured
-    if not logging.root.handlers:
+    # Check if the logging has already been configured. coloredlogs only adds its handler to our
+    # logger, not the root one, so look there - otherwise every plugin import adds another file handler.
+    logger = logging.getLogger(__name__)
+
+    if not logger.handlers:
+        global listener
+
         # Setup a new console logger
-        coloredlogs.install(level="INFO", logger=logging.getLogger(__name__), fmt="%(levelname)s %(message)s")
+        coloredlogs.install(level="INFO", logger=logger, fmt="%(levelname)s %(message)s")
+        console_handler = logger.handlers[0]
+        logger.removeHandler(console_handler)
 
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
         # File logger
         file_handler = logging.FileHandler(os.path.join(paths.app(), 'log_errors.log'))
         file_handler.setLevel(logging.ERROR)
         file_formatter = logging.Formatter("---\n%(asctime)s %(levelname)-8s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
         file_handler.setFormatter(file_formatter)
 
-        logger = logging.getLogger(__name__)
-        logger.addHandler(file_handler)
+        echo_handler = EchoHandler()
+        echo_handler.addFilter(is_echo)
+        for handler in (console_handler, file_handler):
+            handler.addFilter(is_log)
+
+        # The handlers run on the writer thread, the logger only queues records for it
+        listener = Writer(log_queue, console_handler, file_handler, echo_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(stop)
+
+        logger.addHandler(QueueHandler(log_queue))
+        logger.addFilter(hold_filter)
+
+    return logger
+
+# Print a line through the writer thread, in order with the log records around it. Printed
+# whatever the logger's level is, and held back by capture() like any record.
+def echo(message="", end="\n"):
+    if listener is None:
+        print(message, end=end)
+        return
+
+    logger = logging.getLogger(__name__)
+    record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, "%s", (message,), None,
+                               extra={'echo': True, 'end': end})
+    logger.handle(record)
+
+# Wait until everything logged so far has been written
+def flush():
+    if listener is not None:
+        log_queue.join()
+
+# input(), once everything before the prompt is on screen
+def ask(prompt=""):
+    flush()
+    return input(prompt)
+
+# Also write log records as JSON lines, to file_path or to stderr for "-"
+def json_lines(file_path):
+    handler = logging.StreamHandler(sys.stderr) if file_path == "-" else logging.FileHandler(file_path)
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(is_log)
+    listener.handlers += (handler,)
+
+# Write out whatever is still queued and stop the writer thread
+def stop():
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
 
-        return logger
+# Run func, holding back anything it logs from this thread. Returns (result, records).
+def capture(func, *args, **kwargs):
+    _held.records = []
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        records = _held.records
+        _held.records = None
 
-    else:
-        # Logging is already configured, return the existing logger and handler
-        logger = logging.getLogger(__name__)
+    return result, records
 
-        # Assuming the console handler is the first one
-        console_handler = logger.handlers[0]  
-        return logger
+# Emit records held back by capture(), from whichever thread calls this
+def replay(records):
+    for record in records:
+        logger = logging.getLogger(record.name)
+        logger.handle(record)
 
 if __name__ == '__main__':
     # Do nothing.
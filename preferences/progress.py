@@ -0,0 +1,78 @@
+import sys
+import threading
+
+from preferences import logging
+
+
+# Seconds between redraws of the bar
+INTERVAL = 0.5
+
+'''Progress bar'''
+# Files are counted as they're found and as they finish, which only bumps two numbers. The bar is
+# redrawn by its own thread every INTERVAL seconds, however many files finished in between, and
+# log lines and echo() output are written above it. Until start() is called nothing is drawn.
+class Progress:
+    def __init__(self):
+        self.bar = None
+        self.total = 0
+        self.done = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.drawer = None
+
+    @property
+    def active(self):
+        return self.bar is not None
+
+    def start(self, interval=INTERVAL):
+        # Imported when a bar is actually shown
+        from tqdm import tqdm
+
+        # No monitor thread, the bar is only ever redrawn from draw()
+        tqdm.monitor_interval = 0
+        self.bar = tqdm(total=0, unit="file", file=sys.stderr, dynamic_ncols=True, leave=False, mininterval=interval)
+        logging.listener.pause = tqdm.external_write_mode
+
+        self.stopped.clear()
+        self.drawer = threading.Thread(target=self.run, args=(interval,), name="progress", daemon=True)
+        self.drawer.start()
+
+    # More files to do
+    def add(self, count):
+        with self.lock:
+            self.total += count
+
+    # A file is done with, whatever happened to it
+    def advance(self):
+        with self.lock:
+            self.done += 1
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            self.draw()
+
+    def draw(self):
+        with self.lock:
+            total, done = self.total, self.done
+
+        with self.bar.get_lock():
+            self.bar.total = total
+            self.bar.n = done
+            self.bar.refresh()
+
+    # Take the bar off the screen, once everything logged before it has been written
+    def close(self):
+        if not self.active:
+            return
+
+        self.stopped.set()
+        self.drawer.join()
+        logging.flush()
+
+        logging.listener.pause = None
+        self.bar.close()
+        self.bar = None
+
+
+# One bar for the whole run, counted from the lookups and the transfer threads
+display = Progress()
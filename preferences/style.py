@@ -43,9 +43,11 @@ def dark(msg):
     return msg
 
 
+# Erases the current line
+CLEAR_LINE = '\x1b[2K'
+
 def clear_line(): # use after: print("content", end='\r')
-    clear = '\x1b[2K'
-    print(end=clear)
+    print(end=CLEAR_LINE)
 
 
 def logo():
@@ -1,10 +1,14 @@
+import argparse
+import contextlib
+import itertools
 import os
-import re
-import shutil
+from datetime import date
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from preferences import logging, config, style
-from plugins import audiobook, movie, show
+from core import cache, fingerprint, journal, lease, library, metrics, probe, ratelimit, results, scanner, scheduler, state, tags, titles, tmdb, transfer, watch
+from preferences import logging, config, progress, style
+import plugins
 
 
 def welcome_message():
@@ -13,20 +17,27 @@ def welcome_message():
     hr = style.hr()
     tagline = style.blue("Automatic organisation for your media files.")
     card = f"{logo_art}\nv{version}\n{tagline}{hr}"
-    print(card)
+    logging.echo(card)
 
 
 def warn():
     logger.warning("pyButler will move & rename files. It's advisable to have a backup.")
-    supported = f"Supported: {style.bold('.mkv .mp4 .m4b')}"
-    print(supported)
+    supported = f"Supported: {style.bold(' '.join(plugins.EXTENSIONS))}"
+    logging.echo(supported)
 
 
-def move_file(file_path, new_path, logger):
-    print("Moving File...", end="\r")
-    style.clear_line()
+def move_file(file_path, new_path, logger, mode="move", verify=False):
+    if transfer_mode(file_path, mode) != mode:
+        logger.info("Copying %s instead of hardlinking it, its tags need updating", os.path.basename(file_path))
+        mode = "copy"
+
     try:
-        shutil.move(file_path, new_path)
+        # Library folders are only created once a file is on its way into them, each one once a run
+        with metrics.timer("directories"):
+            library.index.makedirs(os.path.dirname(new_path))
+
+        with metrics.timer("transfer"):
+            result = transfer.transfer(file_path, new_path, mode, verify)
 
     except OSError as e:
         logger.error(e)
@@ -34,104 +45,963 @@ def move_file(file_path, new_path, logger):
         logger.info("File not processed. Skipping File..")
 
     else:
-        check_file(new_path)
+        library.index.add(new_path)
+
+        if mode in ("hardlink", "reflink") and result.method != mode:
+            logger.warning("Unable to %s %s here, copied it instead", mode, os.path.basename(file_path))
+
+        # Renames and links don't write any file data
+        if result.method not in ("rename", "hardlink", "reflink"):
+            metrics.count("bytes_copied", result.size)
+
+        # Tags are written at the destination, after the size check against the source
+        if check_file(new_path, result):
+            changed = tags.has_pending(file_path)
+            write_tags(file_path, new_path, logger)
+            fingerprint.index.placed(file_path, new_path, changed)
+            return True
+
+    tags.discard(file_path)
+    library.index.release(new_path)
+    return False
+
+
+# Write the tag changes the lookup found for file_path into the file at new_path
+def write_tags(file_path, new_path, logger):
+    try:
+        tags.write(file_path, new_path)
+    except Exception as e:
+        logger.error("Unable to update the tags of %s: %s", os.path.basename(new_path), e)
+
+
+# A hardlink shares its data with the source, so writing tags to it would change the file being
+# seeded. Audiobooks with tag changes waiting are copied instead.
+def transfer_mode(file_path, mode):
+    if mode == "hardlink" and tags.has_pending(file_path):
+        return "copy"
+    return mode
 
 # Make sure the new_file made it to the destination folder after `move_file()`
-def check_file(new_path):
-    if os.path.exists(new_path):
+def check_file(new_path, result=None):
+    try:
+        size = os.stat(new_path).st_size
+    except FileNotFoundError:
+        return False
+
+    if result is not None and size != result.size:
+        return False
+
+    else:
         msg = "File processed"
         success = style.green("    ✔")
         location = os.path.dirname(new_path)
         filename = style.bold(os.path.basename(new_path))
 
-        style.clear_line()
-        print(f"{success} {msg} | {location} > {filename}")
+        # Throughput is only interesting when bytes were actually copied
+        details = ""
+        if result is not None and result.method not in ("rename", "hardlink", "reflink"):
+            rate = result.size / result.seconds if result.seconds else 0
+            details = style.dark(f" ({transfer.format_size(result.size)} at {transfer.format_size(rate)}/s)")
+
+        logging.echo(f"{success} {msg} | {location} > {filename}{details}")
+        return True
+
+# resolve_file() result for a file that couldn't be looked up because TMDB was unavailable.
+# Unlike a skipped file it isn't recorded as failed, so the next run tries it again.
+RETRY = object()
+
+
+# Work out where a file belongs. Returns the new path, None if the file should be skipped,
+# or RETRY if it should be looked up again later. quality is added to video names when given.
+# classified is the file's (plugin, parsed name) from plugins.classify(), worked out here if not given.
+def resolve_file(file_path, client, configs, logger, quality=None, classified=None):
+    # Which plugin takes the file, by its extension and then its name. The name is parsed once,
+    # the plugin works from the result.
+    plugin, parsed = classified or plugins.classify(file_path)
+
+    if plugin is None:
+        logger.info("%s is not a valid file type. Skipping file...", os.path.splitext(file_path)[1])
+        return None
+
+    try:
+        new_path = plugin.resolve(file_path, client, configs[plugin.name], parsed, quality)
+
+    except UnboundLocalError:
+        logger.info("Skipping file...")
+        return None
+
+    except tmdb.TMDBError as e:
+        logger.error("%s (will try this file again next run)", e)
+        return RETRY
+
+    if new_path is None:
+        logger.info("File not processed. Skipping File..")
+
+    return new_path
+
+
+# Move a resolved file into place. Returns the outcome to record in the state index, or None if
+# the move itself failed (those are always retried).
+def finish_file(file_path, new_path, logger, mode="move", verify=False):
+    if new_path is None:
+        return state.FAILED
+    if new_path is RETRY:
+        return None
+    if library.index.claim(new_path, file_path) is not None:
+        logger.error("%s is already taken, leaving %s where it is", new_path, os.path.basename(file_path))
+        tags.discard(file_path)
+        return state.FAILED
+
+    if move_file(file_path, new_path, logger, mode, verify):
+        return state.MOVED
+
 
 # MAIN FUNCTION - Call from another script using the args
-def process_file(file_path, api_key, configs, logger):
-    file_name = os.path.basename(file_path)
-    extension = os.path.splitext(file_path)[1]
-    pattern = re.search(r"(?i)(S(\d+))(E(\d+))", file_name, re.IGNORECASE)
+def process_file(file_path, client, configs, logger, mode="move", verify=False):
+    new_path = resolve_file(file_path, client, configs, logger)
+    return finish_file(file_path, new_path, logger, mode, verify)
+
+
+# Look files up one at a time, yielding the new path for each. qualities maps files to their quality,
+# classified to their (plugin, parsed name).
+def resolve_sequentially(files, client, configs, logger, qualities=None, classified=None):
+    qualities = qualities or {}
+    classified = classified or {}
+    for file_path in files:
+        logging.echo(f"\nFile: {style.bold(style.dark_grey(os.path.basename(file_path)))}")
+        yield resolve_file(file_path, client, configs, logger, qualities.get(file_path), classified.get(file_path))
+
+
+# Look files up on a pool of workers, yielding the new paths in their original order.
+# Log records from each lookup are held back and replayed alongside the file they belong to.
+def resolve_concurrently(files, client, configs, logger, workers, qualities=None, classified=None):
+    qualities = qualities or {}
+    classified = classified or {}
+
+    def resolve(file_path):
+        return logging.capture(resolve_file, file_path, client, configs, logger, qualities.get(file_path), classified.get(file_path))
+
+    # Lookups waiting on TMDB and ones only reading the disk get a pool each, so neither queues
+    # behind the other. Threads are only started once a pool has work.
+    with ThreadPoolExecutor(max_workers=workers) as network, ThreadPoolExecutor(max_workers=workers) as disk:
+        pools = {plugins.NETWORK: network, plugins.IO: disk}
+        futures = [pools.get(plugins.bound(file_path), network).submit(resolve, file_path) for file_path in files]
+
+        for file_path, future in zip(files, futures):
+            new_path, records = future.result()
+            logging.echo(f"\nFile: {style.bold(style.dark_grey(os.path.basename(file_path)))}")
+            logging.replay(records)
+            yield new_path
+
+
+# Hand a resolved file to the transfer stage. The move runs on the worker for the
+# destination's device and records its own outcome when it's done.
+def queue_transfer(file_path, stat, new_path, transfers, history, logger, args, output=None, source=None):
+    def task():
+        if move_file(file_path, new_path, logger, args.transfer, args.verify):
+            if args.transfer == "move" and source:
+                transfer.prune(os.path.dirname(file_path), source)
+            history.record(stat, file_path, state.MOVED)
+            metrics.count("files_moved")
+            write_result(output, results.MOVED, file_path, source, destination=new_path)
+        else:
+            write_result(output, results.ERROR, file_path, source, destination=new_path)
+
+    # Anything move_file() doesn't handle itself, e.g. a database error. Logged by the scheduler.
+    def failed(e):
+        tags.discard(file_path)
+        library.index.release(new_path)
+        write_result(output, results.ERROR, file_path, source, destination=new_path, error=str(e))
+
+    try:
+        space = transfer.space_needed(file_path, new_path, stat.st_size, transfer_mode(file_path, args.transfer))
+        transfers.submit(new_path, space, task, failed)
+    except OSError as e:
+        logger.error(e)
+        write_result(output, results.ERROR, file_path, source, destination=new_path, error=str(e))
+        library.index.release(new_path)
+
+
+# One JSON line for a file, when running with --batch. Every file's outcome ends up here, which is
+# also where its lease is given back when coordinating with other hosts, and where it counts
+# towards the progress bar.
+def write_result(output, status, file_path, source=None, **fields):
+    lease.leases.release(file_path, placed=status in (results.MOVED, results.DUPLICATE))
+    if status != results.SKIPPED:
+        progress.display.advance()
+
+    if output is not None:
+        output.write(status, file_path, source, **fields)
+
+
+# Search each show once and fetch each of its seasons once, before any episode is looked up.
+# classified maps each file to its (plugin, parsed name).
+def prefetch_shows(classified, client, workers):
+    show_plugin = plugins.get("show")
+    episodes = [parsed for plugin, parsed in classified.values() if plugin is show_plugin]
+    if not episodes:
+        return
+
+    show = show_plugin.module
+    groups = show.group_files(episodes)
+
+    def prefetch(group):
+        try:
+            show.prefetch(*group, client)
+        except tmdb.TMDBError:
+            # Each episode looks its show up again, and reports the error, when it's resolved
+            pass
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(prefetch, groups.items()))
 
-    if extension not in ('.mkv', '.mp4', '.m4b'):
-        logger.info("%s is not a valid file type. Skipping file...", extension)
 
-    # m4b must be an audiobook file
-    elif extension == '.m4b':
+# Resolution and codec of each video in a batch, read from their headers on a pool of threads.
+# Files that can't be probed fall back to the resolution in their parsed name, if there is one.
+def probe_files(classified, workers):
+    videos = [file_path for file_path in classified if os.path.splitext(file_path)[1] in plugins.VIDEO]
+
+    def quality(file_path):
+        parsed = classified[file_path][1]
+        return probe.quality(file_path) or (parsed.resolution if parsed else None)
+
+    with ThreadPoolExecutor(max_workers=max(4, workers)) as pool:
+        return dict(zip(videos, pool.map(quality, videos)))
+
+
+# Should names include the resolution and codec? --quality-tags, or quality_tags in config.json
+def quality_tags(args, configs):
+    return args.quality_tags or configs.get('quality_tags', False)
+
+
+# With --coordinate, keep the files this host wins the lease on, other hosts have the rest.
+# Takes and returns (file_path, stat) pairs.
+def claim_files(files, configs, args):
+    if args.dry_run or not lease.leases.active:
+        return files
+
+    claimed = []
+    for file_path, stat in files:
+        if not lease.leases.claim(file_path, configs['source'], stat):
+            metrics.count("leased_elsewhere")
+            continue
+
+        # Another host may have finished with it between the scan and the claim
+        try:
+            current = os.stat(file_path)
+        except FileNotFoundError:
+            current = None
+        if current is None or (current.st_ino, current.st_size, current.st_mtime_ns) != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            lease.leases.release(file_path)
+            continue
+
+        claimed.append((file_path, stat))
+
+    return claimed
+
+
+# Drop files the state index says to skip. Takes and returns (file_path, stat) pairs.
+def unseen(files, history, args):
+    return [(file_path, stat) for file_path, stat in files if not history.skip(stat, args.retry_failed)]
+
+
+# Drop files identical to one already in the library, or to one earlier in the run, before they're
+# looked up. Only files sharing their size with another are read at all, a few samples each.
+def drop_duplicates(files, history, logger, args, output=None, source=None):
+    kept = []
+
+    for file_path, stat in files:
         try:
-            new_path = audiobook.process(file_path, book_path=configs['audiobook'])
-            move_file(file_path, new_path, logger)
-        except UnboundLocalError:
-            logger.info("Skipping file...")
+            original = fingerprint.index.duplicate(file_path, stat, args.full_hash)
+        except OSError as e:
+            logger.error(e)
+            original = None
+
+        if original is None:
+            kept.append((file_path, stat))
+            continue
+
+        logger.warning("%s is identical to %s, leaving it where it is", os.path.basename(file_path), original)
+        if not args.dry_run:
+            history.record(stat, file_path, state.FAILED)
+        metrics.count("duplicates")
+        write_result(output, results.DUPLICATE, file_path, source, original=original)
+
+    return kept
+
+
+# Look up a batch of (file_path, stat) pairs, prefetching shows first. Duplicates and files that
+# can't be placed are recorded (except on a dry run); yields (file_path, stat, new_path) for the rest.
+def resolve_files(files, client, configs, logger, args, history, output=None):
+    files = drop_duplicates(files, history, logger, args, output, configs['source'])
+    file_paths = [file_path for file_path, stat in files]
+
+    # Each name is parsed once here, for the prefetch, the probe fallback and the lookup alike
+    classified = {file_path: plugins.classify(file_path) for file_path in file_paths}
+    prefetch_shows(classified, client, args.workers)
+    qualities = probe_files(classified, args.workers) if quality_tags(args, configs) else {}
+
+    if args.workers > 1:
+        resolved = resolve_concurrently(file_paths, client, configs, logger, args.workers, qualities, classified)
+    else:
+        resolved = resolve_sequentially(file_paths, client, configs, logger, qualities, classified)
+
+    for (file_path, stat), new_path in zip(files, resolved):
+        if new_path is None:
+            if not args.dry_run:
+                history.record(stat, file_path, state.FAILED)
+            metrics.count("files_failed")
+            write_result(output, results.FAILED, file_path, configs['source'])
+        elif new_path is RETRY:
+            metrics.count("files_retry")
+            write_result(output, results.RETRY, file_path, configs['source'])
+        else:
+            yield file_path, stat, new_path
+
+
+# Reserve a file's destination before anything is moved. Returns False, after reporting why, when
+# the library already has a file by that name or another file in this run is headed there.
+def claim_destination(file_path, stat, new_path, history, logger, args, output=None, source=None):
+    conflict = library.index.claim(new_path, file_path)
 
-    # Figure out if the video file is a TV show or not
-    elif pattern is not None:
+    if conflict == library.EXISTS:
         try:
-            new_path = show.process(file_path, api_key, show_path=configs['show'])
-            move_file(file_path, new_path, logger)
-        except UnboundLocalError:
-            logger.info("Skipping file...")
+            existing = os.stat(new_path)
+        except FileNotFoundError:
+            # Removed since the folder was listed, the name is free after all
+            library.index.remove(new_path)
+            conflict = library.index.claim(new_path, file_path)
+
+    if conflict is None:
+        return True
+
+    tags.discard(file_path)
+    name = os.path.basename(file_path)
+    if conflict == library.CLAIMED:
+        # Not recorded, the other file may not make it
+        logger.error("Another file in this run is already going to %s, leaving %s where it is", new_path, name)
+        metrics.count("conflicts")
+        write_result(output, results.CONFLICT, file_path, source, destination=new_path)
+        return False
+
+    if os.path.samestat(existing, stat):
+        # Hardlinked on an earlier run
+        logger.info("%s is already in the library", name)
+        outcome, status = state.MOVED, results.DUPLICATE
+    elif existing.st_size == stat.st_size and fingerprint.index.identical(file_path, new_path, args.full_hash):
+        logger.warning("A copy of %s is already in the library at %s, leaving it where it is", name, new_path)
+        outcome, status = state.FAILED, results.DUPLICATE
+    else:
+        logger.error("A different file is already in the library at %s, leaving %s where it is", new_path, name)
+        outcome, status = state.FAILED, results.CONFLICT
+
+    if not args.dry_run:
+        history.record(stat, file_path, outcome)
+    metrics.count("duplicates" if status == results.DUPLICATE else "conflicts")
+    write_result(output, status, file_path, source, destination=new_path)
+    return False
+
+
+# Run a batch of (file_path, stat) pairs through the pipeline: prefetch shows and look up each
+# file, then queue it for transfer. Lookups never wait for moves, they carry on with the next file.
+def process_files(files, client, configs, logger, args, history, transfers, output=None):
+    for file_path, stat, new_path in resolve_files(files, client, configs, logger, args, history, output):
+        if claim_destination(file_path, stat, new_path, history, logger, args, output, configs['source']):
+            queue_transfer(file_path, stat, new_path, transfers, history, logger, args, output, configs['source'])
+
+
+# Look up a batch for --plan or --dry-run, without moving anything. Returns the planned transfers
+# as (file_path, destination, mode, stat, tags, source) tuples, ready for the journal.
+def plan_files(files, client, configs, logger, args, history, output=None):
+    planned = []
+
+    for file_path, stat, new_path in resolve_files(files, client, configs, logger, args, history, output):
+        if not claim_destination(file_path, stat, new_path, history, logger, args, output, configs['source']):
+            continue
+
+        # Tag changes travel with the plan, so a resumed run can write them without the lookup
+        pending = tags.pending.pop(file_path, None)
+        planned.append((file_path, new_path, args.transfer, stat, pending, configs['source']))
+
+    return planned
+
+
+# List a plan instead of carrying it out
+def show_plan(planned, output=None):
+    logging.echo(f"\n{style.bold('Plan')} ({len(planned)} files, nothing has been moved):")
+
+    for file_path, destination, mode, stat, pending, source in planned:
+        logging.echo(f"  {file_path}\n    {style.dark('→')} {destination}")
+        write_result(output, results.PLANNED, file_path, source, destination=destination)
+
+
+# Carry out a plan: list it on a dry run, otherwise write it to the journal and start the transfers
+def carry_out(planned, plan_log, transfers, history, logger, args, output=None):
+    if args.dry_run:
+        show_plan(planned, output)
+    elif planned:
+        # The whole plan is on disk before the first file is touched
+        execute_plan(plan_log.add(planned), plan_log, transfers, history, logger, args, output)
+
+
+# Has a planned transfer already happened? Copies only appear under their final name once complete.
+def transferred(entry):
+    if not library.index.exists(entry.destination):
+        return False
+
+    if entry.mode == "move":
+        return not os.path.exists(entry.file_path)
+
+    # Tag changes alter the size, so without them the size has to match too
+    return bool(entry.tags) or os.path.getsize(entry.destination) == entry.size
+
+
+# Carry out planned transfers from the journal, marking each done as it completes. Transfers that
+# already happened before an interruption are only marked done.
+def execute_plan(entries, plan_log, transfers, history, logger, args, output=None):
+    for entry in entries:
+        finished = transferred(entry)
+
+        if not finished:
+            try:
+                stat = os.stat(entry.file_path)
+            except FileNotFoundError:
+                logger.warning("%s is gone, dropping it from the plan", entry.file_path)
+                plan_log.drop(entry.id)
+                write_result(output, results.ERROR, entry.file_path, entry.source, destination=entry.destination,
+                             error="gone since it was planned")
+                continue
+
+            if (stat.st_size, stat.st_mtime_ns) != (entry.size, entry.mtime_ns):
+                logger.warning("%s changed since it was planned, it will be looked up again", entry.file_path)
+                plan_log.drop(entry.id)
+                write_result(output, results.RETRY, entry.file_path, entry.source)
+                continue
+
+            # The library may have changed since the plan was made, e.g. by another run. A conflict
+            # or duplicate is reported by claim_destination.
+            if not claim_destination(entry.file_path, stat, entry.destination, history, logger, args, output, entry.source):
+                plan_log.drop(entry.id)
+                continue
+
+        queue_planned(entry, finished, plan_log, transfers, history, logger, args, output)
+
+
+def queue_planned(entry, finished, plan_log, transfers, history, logger, args, output=None):
+    def task():
+        if entry.tags:
+            tags.pending[entry.file_path] = entry.tags
+
+        if finished:
+            # Only the tags may be missing, writing them again is harmless
+            write_tags(entry.file_path, entry.destination, logger)
+        elif not move_file(entry.file_path, entry.destination, logger, entry.mode, args.verify):
+            write_result(output, results.ERROR, entry.file_path, entry.source, destination=entry.destination)
+            return
+        elif entry.mode == "move" and entry.source:
+            transfer.prune(os.path.dirname(entry.file_path), entry.source)
+
+        plan_log.done(entry.id)
+        history.record(journal.entry_stat(entry), entry.file_path, state.MOVED)
+        metrics.count("files_moved")
+        write_result(output, results.MOVED, entry.file_path, entry.source, destination=entry.destination)
+
+    # Left in the journal, so a resumed run tries it again
+    def failed(e):
+        tags.discard(entry.file_path)
+        write_result(output, results.ERROR, entry.file_path, entry.source, destination=entry.destination, error=str(e))
+
+    try:
+        space = 0 if finished else transfer.space_needed(entry.file_path, entry.destination, entry.size, entry.mode)
+        transfers.submit(entry.destination, space, task, failed)
+    except OSError as e:
+        logger.error(e)
+        write_result(output, results.ERROR, entry.file_path, entry.source, destination=entry.destination, error=str(e))
+
+
+# Finish the transfers an interrupted --plan run left in the journal. Needs no lookups.
+def resume_plan(plan_log, transfers, history, logger, args, output=None):
+    entries = plan_log.pending()
+    if not entries:
+        return
+
+    if args.dry_run:
+        logger.info("%d transfers from an interrupted run are waiting, run without --dry-run to finish them", len(entries))
+        return
+
+    logger.info("Resuming %d transfers planned by an interrupted run...", len(entries))
+    progress.display.add(len(entries))
+    execute_plan(entries, plan_log, transfers, history, logger, args, output)
+    transfers.join()
+    plan_log.clear_done()
+
+
+# Scan the source in batches, yielding the source's configs, the files in each batch that need
+# looking at (as (file_path, stat) pairs) and how many were skipped as unchanged since a previous run.
+# `targets` are every library directory, never scanned even when inside a source. Under --watch,
+# files still being written are left to `watcher` until they settle.
+def scan_source(configs, history, args, targets=(), output=None, watcher=None):
+    entries = scanner.scan(configs['source'], plugins.EXTENSIONS, depth=args.depth, include=args.include,
+                           exclude=args.exclude, skip=targets or (configs['movie'], configs['show'], configs['audiobook']))
+
+    # Hosts sharing the source claim files as they get to them, a batch at a time, so smaller batches
+    # spread the files more evenly
+    size = args.workers * 2 if lease.leases.active else max(32, args.workers * 4)
+
+    for batch in scanner.batches(entries, size):
+        found = []
+        for entry in batch:
+            try:
+                found.append((entry.path, entry.stat()))
+            except FileNotFoundError:
+                # Moved away since the scan listed it
+                continue
+        files = unseen(found, history, args)
+        skipped = len(found) - len(files)
+
+        if output is not None:
+            wanted = {file_path for file_path, stat in files}
+            for file_path, stat in found:
+                if file_path not in wanted:
+                    write_result(output, results.SKIPPED, file_path, configs['source'])
+
+        # Held back rather than skipped, the watcher hands them over once they settle
+        if watcher is not None:
+            files = watcher.settled_files(files)
+
+        yield configs, claim_files(files, configs, args), skipped
+
+
+# Scan up to the first batch with files to process. Returns that batch (or None if the scan found
+# nothing to do) and the number of files skipped on the way.
+def first_batch(batches):
+    skipped = 0
+
+    for source, files, batch_skipped in batches:
+        if files:
+            return (source, files, batch_skipped), skipped
+        skipped += batch_skipped
+
+    return None, skipped
+
+
+# "DIR" or "DIR,movie=DIR,show=DIR,audiobook=DIR" from --source, as a dict of directories
+def source_spec(text):
+    directory, *overrides = text.split(",")
+    spec = {"source": directory}
+
+    for override in overrides:
+        kind, _, target = override.partition("=")
+        if kind not in ('movie', 'show', 'audiobook') or not target:
+            raise argparse.ArgumentTypeError(f"expected movie=DIR, show=DIR or audiobook=DIR, not '{override}'")
+        spec[kind] = target
+
+    return spec
+
+
+# Every source to process, each with its own full set of directories: --source, then "sources" in
+# config.json, then the single "source". Targets a source doesn't override come from config.json.
+def source_configs(args, configs, logger):
+    listed = args.source or configs.get('sources') or [configs['source']]
+    sources = []
+
+    for entry in listed:
+        spec = source_spec(entry) if isinstance(entry, str) else entry
+        source = {**configs, **spec}
+
+        missing = [source[key] for key in config.DIRECTORIES if not os.path.isdir(source[key])]
+        if missing:
+            logger.error("Skipping source %s, these directories don't exist: %s", source['source'], ", ".join(missing))
+            continue
+
+        sources.append(source)
+
+    return sources
+
+
+# How the scan went, at the end of a run. `waiting` files are still being written, under --watch.
+def report(count, skipped, waiting=0):
+    if skipped:
+        logger.info("Skipped %d unchanged files seen on a previous run (use --retry-failed to look them up again)", skipped)
+
+    if waiting:
+        logger.info("%d files are still being written, they'll be processed once they settle", waiting)
+
+    if count < 1 and skipped < 1:
+        if not waiting:
+            logger.info("No valid files were found!")
 
-    # Conclude at this point, the file must be a movie
     else:
+        logging.echo(f"\n{style.blue('Complete.')}")
+
+
+# Daemon mode: keep watching the source directory and process files as they finish arriving
+def watch_source(watcher, client, configs, logger, args, history, transfers, plan_log, output=None):
+    logging.echo(style.dark(f"\nWatching {configs['source']} ({watcher.backend})..."))
+
+    for file_paths in watcher:
+        files = []
+        for file_path in file_paths:
+            try:
+                files.append((file_path, os.stat(file_path)))
+            except FileNotFoundError:
+                continue
+
+        # The library may have changed since the last batch, TMDB may know about new episodes or
+        # titles it had no match for, and files seen in the source before may have been replaced
+        library.index.refresh()
+        plugins.forget()
+        fingerprint.index.forget()
+        files = claim_files(unseen(files, history, args), configs, args)
+        if not files:
+            continue
+
+        progress.display.add(len(files))
+        if args.plan or args.dry_run:
+            carry_out(plan_files(files, client, configs, logger, args, history, output),
+                      plan_log, transfers, history, logger, args, output)
+            # Transfers from earlier batches that have finished by now
+            plan_log.clear_done()
+        else:
+            process_files(files, client, configs, logger, args, history, transfers, output)
+        export_metrics(args, configs, logger)
+
+
+# Size cap for the metadata cache: --cache-size, then config.json, then the default
+def cache_size(args, configs):
+    return args.cache_size or configs.get('cache_size_mb', cache.DEFAULT_SIZE_MB)
+
+
+# Where to write run metrics: --metrics-file, then metrics_file in config.json. None to not write them.
+def metrics_file(args, configs):
+    return args.metrics_file or configs.get('metrics_file')
+
+
+# Write the metrics so far, when asked for
+def export_metrics(args, configs, logger):
+    file_path = metrics_file(args, configs)
+    if file_path:
         try:
-            new_path = movie.process(file_path, api_key, movie_path=configs['movie'])
-            move_file(file_path, new_path, logger)
-        except UnboundLocalError:
-            logger.info("Skipping file...")
+            metrics.write(metrics.registry.snapshot(), file_path)
+        except OSError as e:
+            logger.error("Unable to write metrics: %s", e)
+
+
+# Where the run's time went, stage by stage
+def print_metrics():
+    lines = metrics.summary(metrics.registry.snapshot())
+    if lines:
+        logging.echo(style.dark("\n".join(["", "Run metrics:"] + lines)))
+
+
+# `pybutler.py cache stats|prune`
+def cache_command(args):
+    metadata = cache.MetadataCache(max_size_mb=cache_size(args, config.peek()))
 
+    if args.action == 'prune':
+        removed = metadata.prune()
+        logging.echo(style.green(f"Pruned {removed} cache entries"))
+
+    stats = metadata.stats()
+    megabytes = lambda size: f"{size / 1024:.0f} KB" if size < 1024 * 1024 else f"{size / 1024 / 1024:.1f} MB"
+
+    logging.echo(style.dark(f"Cache   → {stats['path']}"))
+    logging.echo(f"Entries → {stats['entries']} ({stats['negative']} no results, {stats['expired']} expired)")
+    logging.echo(f"Size    → {megabytes(stats['size'])} of {megabytes(stats['max_size'])}")
+
+    for endpoint, endpoint_stats in stats['endpoints'].items():
+        logging.echo(f"  {endpoint:<28} {endpoint_stats['entries']:>7} {megabytes(endpoint_stats['size']):>10}")
+
+    metadata.close()
+
+
+# `pybutler.py index update|stats`
+def index_command(args):
+    if args.action == 'update':
+        exports = {kind: file_path for kind, file_path in (('movie', args.movies), ('tv', args.shows)) if file_path}
+        logging.echo(style.dark("Building the local title index..."))
+        titles.build(exports, day=args.date, logger=logger)
+
+    if not titles.index_file().exists():
+        logger.info("No local title index yet. Run 'pybutler.py index update' to build one.")
+        return
+
+    index = titles.TitleIndex()
+    logging.echo(style.dark(f"Index   → {index.path}"))
+    for kind, kind_stats in index.stats().items():
+        logging.echo(f"{kind:<7} → {kind_stats['titles']} titles ({kind_stats['with_year']} with a known year)")
+    index.close()
+
+
+# `pybutler.py library scan|stats`
+def library_command(args):
+    configs = config.peek()
+    index = fingerprint.index
+
+    if args.action == 'scan':
+        # Every library, including the ones sources in config.json send their files to
+        specs = [spec for spec in configs.get('sources', []) if isinstance(spec, dict)]
+        directories = sorted({spec[kind] for spec in [configs] + specs for kind in ('movie', 'show', 'audiobook') if spec.get(kind)})
+
+        logging.echo(style.dark("Recording the files in your libraries..."))
+        added, removed = index.scan(directories, plugins.EXTENSIONS)
+        logging.echo(style.green(f"Recorded {added} new or changed files, forgot {removed} that are gone"))
+
+    stats = index.stats()
+    logging.echo(style.dark(f"Library → {stats['path']}"))
+    logging.echo(f"Files   → {stats['files']} ({stats['fingerprinted']} fingerprinted, {transfer.format_size(stats['size'])})")
+    index.close()
+
+
+# Attach the local title index to the client when --offline-index (or offline_index in config.json) asks for it
+def offline_index(args, configs, client):
+    if not (args.offline_index or configs.get('offline_index')):
+        return
+
+    if titles.index_file().exists():
+        client.titles = titles.TitleIndex()
+    else:
+        logger.warning("No local title index found, searching TMDB instead. Run 'pybutler.py index update' to build one.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="pybutler", description="Automatic organisation for your media files.")
+    parser.add_argument("-w", "--workers", type=int, default=1, metavar="N",
+                        help="number of files to look up concurrently (default: 1)")
+    parser.add_argument("--cache-size", type=float, metavar="MB",
+                        help=f"size cap for the metadata cache (default: {cache.DEFAULT_SIZE_MB})")
+    parser.add_argument("--rate-limit", type=float, default=ratelimit.RATE_LIMIT, metavar="N",
+                        help=f"most TMDB requests to send a second, shared by all workers (default: {ratelimit.RATE_LIMIT}, 0 for no limit)")
+    parser.add_argument("--depth", type=int, default=1, metavar="N",
+                        help="how many levels of sub-folders in the source to look inside (default: 1, -1 for no limit)")
+    parser.add_argument("--include", action="append", default=[], metavar="GLOB",
+                        help="only process files matching this pattern (can be repeated)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB",
+                        help="skip files and folders matching this pattern, e.g. '*sample*' (can be repeated)")
+    parser.add_argument("--source", action="append", type=source_spec, metavar="DIR[,KIND=DIR]",
+                        help="a source directory to process instead of the one in config.json (can be repeated). "
+                             "Add movie=, show= or audiobook= to send its files somewhere else, e.g. "
+                             "'/downloads/kids,movie=/media/kids/movies'")
+    parser.add_argument("--batch", action="store_true",
+                        help="run unattended: no prompts, and print one JSON line per file to stdout "
+                             "(other output goes to stderr)")
+    parser.add_argument("--plan", action="store_true",
+                        help="look up every file before moving any, keeping the plan in a journal so an "
+                             "interrupted run picks up where it stopped")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="look up every file and show where it would go, without moving anything")
+    parser.add_argument("--quality-tags", action="store_true",
+                        help="add the resolution and codec read from each video to its new name, "
+                             "e.g. 'Some Movie (2017) [1080p HEVC].mkv'")
+    parser.add_argument("--coordinate", action="store_true",
+                        help="share the source folders with pyButler on other hosts: each file is leased to one "
+                             "host at a time")
+    parser.add_argument("--lease", type=float, default=lease.LEASE_TTL, metavar="SECONDS",
+                        help=f"with --coordinate, how long a crashed host's files stay leased (default: {lease.LEASE_TTL})")
+    parser.add_argument("--transfer", choices=transfer.MODES, default="move",
+                        help="how files get to the library: move (default), hardlink or reflink to keep seeding "
+                             "without using extra space, or copy")
+    parser.add_argument("--full-hash", action="store_true",
+                        help="before skipping a file as a duplicate of one in the library, compare the whole "
+                             "of both files rather than samples")
+    parser.add_argument("--verify", action="store_true",
+                        help="checksum files copied between filesystems before the source is removed")
+    parser.add_argument("--per-device", type=int, default=1, metavar="N",
+                        help="how many transfers may run at once on each destination disk (default: 1)")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="look up files again that failed on a previous run, even if they haven't changed")
+    parser.add_argument("--offline-index", action="store_true",
+                        help="search titles in the local index built by 'index update' before asking TMDB")
+    parser.add_argument("--metrics-file", metavar="FILE",
+                        help="write per-stage timings and counters here after a run, as a Prometheus textfile "
+                             "if it ends in .prom, JSON otherwise")
+    parser.add_argument("--progress", action="store_true",
+                        help="show a progress bar on stderr, when it's a terminal")
+    parser.add_argument("--log-json", metavar="FILE",
+                        help="also write log messages here as JSON lines, '-' for stderr")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process new files as they arrive in the source directory")
+    parser.add_argument("--settle", type=float, default=5, metavar="SECONDS",
+                        help="with --watch, how long a file must stay unchanged before it is processed (default: 5)")
+    parser.add_argument("--poll-interval", type=float, default=10, metavar="SECONDS",
+                        help="with --watch, how often to rescan when inotify is unavailable (default: 10)")
+
+    commands = parser.add_subparsers(dest="command")
+    cache_parser = commands.add_parser("cache", help="show or prune the TMDB metadata cache")
+    cache_parser.add_argument("action", choices=("stats", "prune"))
+    index_parser = commands.add_parser("index", help="build or inspect the local TMDB title index")
+    index_parser.add_argument("action", choices=("update", "stats"))
+    index_parser.add_argument("--date", type=date.fromisoformat, metavar="YYYY-MM-DD",
+                              help="which day's export to download (default: yesterday)")
+    index_parser.add_argument("--movies", metavar="FILE", help="use an already downloaded movie_ids export")
+    index_parser.add_argument("--shows", metavar="FILE", help="use an already downloaded tv_series_ids export")
+    library_parser = commands.add_parser("library", help="record the files already in the libraries, to catch duplicates")
+    library_parser.add_argument("action", choices=("scan", "stats"))
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    if args.per_device < 1:
+        parser.error("--per-device must be at least 1")
+
+    if args.depth < 0:
+        args.depth = None
+
+    if args.lease <= 0:
+        parser.error("--lease must be more than 0")
+
+    return args
+
+
+def main(args):
+    # With --batch, stdout only carries the JSON lines, everything meant for people goes to stderr
+    if args.batch:
+        output = results.JsonLines(sys.stdout)
+        with contextlib.redirect_stdout(sys.stderr):
+            try:
+                return run(args, output)
+            finally:
+                # Lines still queued are meant for stderr too
+                logging.flush()
+
+    return run(args)
+
+
+def run(args, output=None):
+    # Moves run in the background, one queue per destination device
+    transfers = scheduler.Scheduler(per_device=args.per_device, logger=logger)
 
-def main():
     try:
         # Warning message
         warn()
 
-        # Setup TMDB API Key
-        api = config.Auth()
-
         # Setup config / paths to directories
-        prefs = config.Config()
+        # Under --batch a missing or broken config ends the run, there's nobody to ask
+        prefs = config.Config(interactive=not args.batch)
 
         # Read the directories from config file
         configs = prefs.read()
 
-        # Display logo card
-        welcome_message()
-        prefs.display()
+        # Each source with the directories its files go to
+        sources = source_configs(args, configs, logger)
+        targets = tuple({source[kind] for source in sources for kind in ('movie', 'show', 'audiobook')})
 
-        enter = style.bold("ENTER")
-        input(f"\nPress {enter} to start...")
-        count = 0
+        # What happened to each source file on previous runs
+        history = state.StateIndex()
+
+        # Other hosts may be working through the same sources, files are leased before they're looked at
+        if args.coordinate:
+            lease.leases.start(args.lease)
 
-        for file in os.listdir(configs['source']):
-            file_path = os.path.join(configs['source'], file)
-            extension = extension = os.path.splitext(file)[1]
+        if args.log_json:
+            logging.json_lines(args.log_json)
 
-            # Quick and dirty check for supported file types
-            if extension in ('.mkv', '.mp4', '.m4b'):
-                print (f"\nFile: {style.bold(style.dark_grey(file))}")
-                process_file(file_path, api.key, configs, logger)
-                count += 1
+        # Transfers an interrupted --plan run didn't get to are finished first
+        plan_log = journal.Journal()
+        resume_plan(plan_log, transfers, history, logger, args, output)
+
+        watcher = None
+        if args.watch:
+            if len(sources) != 1:
+                logger.error("--watch follows a single source directory, %d were given", len(sources))
+                return
+
+            # Start watching before the first scan, so nothing that lands in between is missed
+            watcher = watch.Watcher(sources[0]['source'], plugins.EXTENSIONS, settle=args.settle,
+                                    interval=args.poll_interval, logger=logger, depth=args.depth,
+                                    include=args.include, exclude=args.exclude)
+
+        # Files are handed over in batches as the scan finds them, so work starts straight away.
+        # All sources share one client, cache and set of transfer queues.
+        batches = itertools.chain.from_iterable(scan_source(source, history, args, targets, output, watcher) for source in sources)
+
+        # Find the first batch with something to do before anything slow happens. When there's
+        # none, a scheduled run exits without checking the key, opening the cache or waiting for ENTER.
+        first, skipped = first_batch(batches)
+        if first is None and not args.watch:
+            report(0, skipped)
+            return
+
+        # One TMDB client for the whole run, shared by every plugin
+        client = tmdb.Client(pool_size=max(10, args.workers), rate_limit=args.rate_limit)
+
+        # Setup TMDB API Key
+        api = config.Auth(client=client, interactive=not args.batch)
+        client.api_key = api.key
 
+        # Persistent metadata cache in the app directory. Hosts coordinating with --coordinate keep
+        # one each, the share only holds the leases.
+        client.cache = cache.MetadataCache(max_size_mb=cache_size(args, configs))
+        client.load_resolved()
+        offline_index(args, configs, client)
+
+        # Don't wait for a keypress when running unattended
+        if not args.batch:
+            # Display logo card
+            welcome_message()
+            prefs.display()
+
+            if not args.watch:
+                enter = style.bold("ENTER")
+                logging.ask(f"\nPress {enter} to start...")
+
+        # A bar only makes sense on a terminal, it's redrawn in place
+        if args.progress and sys.stderr.isatty():
+            progress.display.start()
+
+        count = 0
+        planned = []
+        for source, files, batch_skipped in itertools.chain([first] if first else [], batches):
+            progress.display.add(len(files))
+            if args.plan or args.dry_run:
+                planned += plan_files(files, client, source, logger, args, history, output)
             else:
-                pass
+                process_files(files, client, source, logger, args, history, transfers, output)
+            count += len(files)
+            skipped += batch_skipped
 
-        if count < 1:
-            logger.info("No valid files were found!")
+        carry_out(planned, plan_log, transfers, history, logger, args, output)
 
-        else:
-            print(f"\n{style.blue('Complete.')}")
+        # Let the last moves finish
+        transfers.join()
+        plan_log.clear_done()
+
+        if count:
+            print_metrics()
+        export_metrics(args, configs, logger)
+
+        report(count, skipped, len(watcher.pending) if watcher else 0)
+
+        if args.watch:
+            watch_source(watcher, client, sources[0], logger, args, history, transfers, plan_log, output)
 
     # Ctrl + C handling
     except KeyboardInterrupt:
-        print('')
-        logger.info("pyButler interrupted by user. Exiting app..")
+        logging.echo()
+        logger.info("pyButler interrupted by user. Finishing the current move and exiting app..")
+        transfers.cancel()
         sys.exit(0)
 
+    # Leases still held go back straight away, rather than when they expire
+    finally:
+        lease.leases.close()
+        progress.display.close()
+
 #   Solo Run.
 if __name__ == "__main__":
     # Setup logging on the outside
     logger = logging.setup()
 
+    args = parse_args()
+
     # Run
-    main()
+    if args.command == "cache":
+        cache_command(args)
+    elif args.command == "index":
+        index_command(args)
+    elif args.command == "library":
+        library_command(args)
+    else:
+        main(args)